@@ -0,0 +1,129 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Compares estimate_skew against the exhaustive full resolution search
+deskew_image used to run, on the images in data/img.
+
+    poetry run python benchmarks/deskew.py [folder] [--synthetic]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+from scipy.ndimage import rotate
+
+from receipt_parser_core.enhancer import estimate_skew
+
+
+def reference_skew(image, delta=1, limit=5):
+    """ The original search: rotate the full image once per angle """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+
+    scores = []
+    angles = np.arange(-limit, limit + delta, delta)
+    for angle in angles:
+        histogram = np.sum(rotate(thresh, angle, reshape=False, order=0), axis=1)
+        scores.append(np.sum((histogram[1:] - histogram[:-1]) ** 2))
+
+    return float(angles[scores.index(max(scores))])
+
+
+def synthetic_receipts(angles=(-4.2, -2.5, -1, 0, 1.3, 3, 4.6), height=1600, width=1200):
+    """ Rendered text lines, skewed by known angles """
+    rng = np.random.default_rng(0)
+    for angle in angles:
+        img = np.full((height, width, 3), 255, np.uint8)
+        for y in range(80, height - 80, 45):
+            text = "".join(rng.choice(list("ABCDEFGHIJ 0123456789,."), 30))
+            cv2.putText(img, text, (60, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (0, 0, 0), 2)
+
+        M = cv2.getRotationMatrix2D((width // 2, height // 2), angle, 1.0)
+        yield "synthetic %+.1f" % angle, cv2.warpAffine(img, M, (width, height), borderValue=(255, 255, 255))
+
+
+def synthetic_photos(backgrounds=(60, 110, 160), height=2250, width=3000):
+    """ Rendered receipts photographed at an angle on a textured table """
+    rng = np.random.default_rng(1)
+    receipt = np.full((1800, 700, 3), 245, np.uint8)
+    for y in range(80, 1740, 45):
+        text = "".join(rng.choice(list("ABCDEFGHIJ 0123456789,."), 18))
+        cv2.putText(receipt, text, (30, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (20, 20, 20), 2)
+
+    ys, xs = np.mgrid[0:height, 0:width]
+    corners = np.float32([[0, 0], [700, 0], [700, 1800], [0, 1800]])
+    cx, cy = width / 2, height / 2
+    target = np.float32([[cx - 380, cy - 950], [cx + 330, cy - 900], [cx + 390, cy + 930], [cx - 350, cy + 960]])
+    M = cv2.getPerspectiveTransform(corners, target)
+    paper = cv2.warpPerspective(np.full(receipt.shape[:2], 255, np.uint8), M, (width, height)) > 0
+
+    for background in backgrounds:
+        table = background + 40 * np.sin(xs / 97.0) * np.cos(ys / 131.0) + rng.normal(0, 12, (height, width))
+        table = table.clip(0, 255).astype(np.uint8)
+        img = cv2.merge([table, (table * 0.8).astype(np.uint8), (table * 0.6).astype(np.uint8)])
+        img[paper] = cv2.warpPerspective(receipt, M, (width, height))[paper]
+        yield "photo on %d" % background, img
+
+
+def folder_images(folder):
+    for name in sorted(os.listdir(folder)):
+        img = cv2.imread(os.path.join(folder, name))
+        if img is not None:
+            yield name, img
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("folder", nargs="?", default="data/img")
+    parser.add_argument("--synthetic", action="store_true", help="also run on rendered, skewed receipts")
+    args = parser.parse_args()
+
+    images = list(folder_images(args.folder))
+    if args.synthetic or not images:
+        images += list(synthetic_receipts())
+
+    mismatches = 0
+    total_reference, total_estimate = 0.0, 0.0
+    print("%-20s %10s %10s %12s %12s" % ("image", "reference", "estimate", "reference s", "estimate s"))
+    for name, img in images:
+        start = time.perf_counter()
+        reference = reference_skew(img)
+        reference_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        estimate = estimate_skew(img)
+        estimate_time = time.perf_counter() - start
+
+        total_reference += reference_time
+        total_estimate += estimate_time
+
+        # the reference only has 1° precision
+        if abs(reference - estimate) > 0.5:
+            mismatches += 1
+
+        print("%-20s %10.1f %10.1f %12.3f %12.3f" % (name, reference, estimate, reference_time, estimate_time))
+
+    print("speedup: %.1fx, mismatches: %d" % (total_reference / max(total_estimate, 1e-9), mismatches))
+
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
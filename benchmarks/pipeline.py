@@ -0,0 +1,291 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Times every stage of the enhancer and the parser on data/img and
+tests/data/receipts, and the import time of the package modules, and
+writes the results as JSON.
+
+    poetry run python benchmarks/pipeline.py run -o before.json
+    poetry run python benchmarks/pipeline.py run -o after.json
+    poetry run python benchmarks/pipeline.py compare before.json after.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+import cv2
+import numpy as np
+
+from receipt_parser_core import enhancer
+from receipt_parser_core.config import read_config
+from receipt_parser_core.ocr import tesseract_version
+from receipt_parser_core.receipt import Receipt
+
+from deskew import folder_images, synthetic_photos, synthetic_receipts
+
+IMAGE_STAGES = [
+    ("rescale_image", enhancer.rescale_image),
+    ("orient_image", enhancer.orient_image),
+    ("deskew_image", enhancer.deskew_image),
+    ("remove_shadows", enhancer.remove_shadows),
+    ("grayscale_image", enhancer.grayscale_image),
+    ("remove_noise", enhancer.remove_noise),
+]
+
+PARSE_STAGES = ["parse_market", "parse_date", "parse_sum", "parse_items"]
+
+# modules whose import time is measured in a fresh interpreter
+IMPORTS = [
+    "receipt_parser_core",
+    "receipt_parser_core.receipt",
+    "receipt_parser_core.parse",
+    "receipt_parser_core.enhancer",
+]
+
+IMPORT_SCRIPT = "import time; start = time.perf_counter(); import {0}; print(time.perf_counter() - start)"
+
+
+class Recorder(object):
+    """
+    Collects durations per stage, or the peak memory traced by
+    tracemalloc while it is running. Tracing slows the stages down
+    several times, so both are never measured in the same pass.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.peak_memory = defaultdict(int)
+
+    def measure(self, stage, function, *args):
+        if not tracemalloc.is_tracing():
+            start = time.perf_counter()
+            result = function(*args)
+            self.durations[stage].append(time.perf_counter() - start)
+            return result
+
+        tracemalloc.reset_peak()
+        result = function(*args)
+
+        _, peak = tracemalloc.get_traced_memory()
+        self.peak_memory[stage] = max(self.peak_memory[stage], peak)
+
+        return result
+
+    def record(self, stage, duration):
+        self.durations[stage].append(duration)
+
+    def summary(self):
+        stages = {}
+        for stage, durations in self.durations.items():
+            durations = np.array(durations)
+            stages[stage] = {
+                "n": len(durations),
+                "mean": float(durations.mean()),
+                "min": float(durations.min()),
+                "max": float(durations.max()),
+                "p50": float(np.percentile(durations, 50)),
+                "p90": float(np.percentile(durations, 90)),
+                "p99": float(np.percentile(durations, 99)),
+                "peak_memory": self.peak_memory[stage],
+            }
+        return stages
+
+
+def tesseract_available():
+    try:
+        tesseract_version()
+        return True
+    except Exception:
+        return False
+
+
+def benchmark_images(recorder, images, language, repeat, ocr):
+    for _ in range(repeat):
+        for _, img in images:
+            for stage, function in IMAGE_STAGES:
+                img = recorder.measure(stage, function, img)
+
+            if ocr:
+                recorder.measure("run_tesseract", enhancer.ocr_image, img, language)
+
+
+def benchmark_pipelines(recorder, images, language, repeat, ocr):
+    """
+    Times the full, the grayscale first, the adaptive and the cropping
+    pipeline, returns the adaptive plan of every image and, with OCR, how
+    similar the texts of the other pipelines are to the full one.
+    """
+
+    report = {}
+    for _ in range(repeat):
+        for name, img in images:
+            full = recorder.measure("enhance_full", enhancer.enhance_image, img)
+            gray_first = recorder.measure("enhance_grayscale_first", enhancer.enhance_image, img,
+                                          None, True, True, True, False, True)
+            adaptive, plan = recorder.measure("enhance_adaptive", enhancer.enhance_adaptive, img)
+            cropped = recorder.measure("enhance_cropped", enhancer.enhance_image, img,
+                                       None, True, True, True, False, False, True)
+
+            report[name] = {"plan": str(plan)}
+            if ocr:
+                full_text = enhancer.ocr_image(full, language)
+                for variant, enhanced in (("grayscale_first", gray_first), ("adaptive", adaptive),
+                                          ("cropped", cropped)):
+                    text = enhancer.ocr_image(enhanced, language)
+                    report[name][variant + "_similarity"] = SequenceMatcher(None, full_text, text).ratio()
+
+    return report
+
+
+def benchmark_receipts(recorder, config, receipts, repeat):
+    for _ in range(repeat):
+        for lines in receipts:
+            receipt = recorder.measure("Receipt", Receipt, config, lines)
+            for stage in PARSE_STAGES:
+                recorder.measure(stage, getattr(receipt, stage))
+
+
+def benchmark_imports(recorder, repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+
+    for _ in range(repeat):
+        for module in IMPORTS:
+            output = subprocess.run(
+                [sys.executable, "-c", IMPORT_SCRIPT.format(module)],
+                cwd=root, env=env, check=True, capture_output=True, text=True
+            ).stdout
+            recorder.record("import " + module, float(output))
+
+
+def run(args):
+    config = read_config(args.config)
+
+    images = list(folder_images(args.images))
+    if args.synthetic or not images:
+        images += list(synthetic_receipts()) + list(synthetic_photos())
+
+    receipts = []
+    for name in sorted(os.listdir(args.receipts)):
+        with open(os.path.join(args.receipts, name), encoding="utf8", errors="ignore") as receipt:
+            receipts.append(receipt.readlines())
+
+    ocr = not args.no_ocr and tesseract_available()
+
+    recorder = Recorder()
+    benchmark_images(recorder, images, config.language, args.repeat, ocr)
+    adaptive = benchmark_pipelines(recorder, images, config.language, args.repeat, ocr)
+    benchmark_receipts(recorder, config, receipts, args.repeat)
+
+    # one more pass for the peak memory of the Python and NumPy allocations,
+    # tesseract runs outside of them
+    tracemalloc.start()
+    benchmark_images(recorder, images, config.language, 1, False)
+    benchmark_pipelines(recorder, images, config.language, 1, False)
+    benchmark_receipts(recorder, config, receipts, 1)
+    tracemalloc.stop()
+
+    if not args.no_imports:
+        benchmark_imports(recorder, args.repeat)
+
+    results = {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "tesseract": tesseract_version() if ocr else None,
+            "images": [name for name, _ in images],
+            "receipts": len(receipts),
+            "repeat": args.repeat,
+            "adaptive": adaptive,
+        },
+        "stages": recorder.summary(),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(output)
+    else:
+        with open(args.output, "w") as out:
+            out.write(output)
+
+    return 0
+
+
+def compare(args):
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)["stages"]
+    with open(args.current) as current_file:
+        current = json.load(current_file)["stages"]
+
+    regressions = 0
+    print("%-36s %12s %12s %9s" % ("stage", "baseline", "current", "change"))
+    for stage in sorted(set(baseline) | set(current)):
+        if stage not in baseline or stage not in current:
+            print("%-36s %s" % (stage, "only in " + ("current" if stage in current else "baseline")))
+            continue
+
+        before, after = baseline[stage][args.metric], current[stage][args.metric]
+        change = (after - before) / before if before else 0.0
+
+        flag = ""
+        if change > args.threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+
+        print("%-36s %12.6f %12.6f %+8.1f%%%s" % (stage, before, after, change * 100, flag))
+
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="benchmark all stages")
+    run_parser.add_argument("-o", "--output", default="-", help="JSON file to write, - for stdout")
+    run_parser.add_argument("-n", "--repeat", type=int, default=5, help="runs per input")
+    run_parser.add_argument("--config", default="config.yml")
+    run_parser.add_argument("--images", default="data/img")
+    run_parser.add_argument("--receipts", default="tests/data/receipts")
+    run_parser.add_argument("--synthetic", action="store_true", help="also run on rendered receipts")
+    run_parser.add_argument("--no-ocr", action="store_true", help="skip the tesseract stage")
+    run_parser.add_argument("--no-imports", action="store_true", help="skip the import time measurements")
+    run_parser.set_defaults(function=run)
+
+    compare_parser = commands.add_parser("compare", help="flag regressions between two runs")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--metric", default="p50", choices=["mean", "p50", "p90", "p99"])
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown that counts as regression")
+    compare_parser.set_defaults(function=compare)
+
+    args = parser.parse_args()
+    return args.function(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
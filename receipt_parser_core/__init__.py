@@ -1,9 +1,72 @@
-from .config import read_config
-from .parse import *
+import importlib
+
+# Attributes are imported on first access, so text-only consumers never
+# load the image stack, terminaltables or argparse
+_LAZY = {
+  "Receipt": ".receipt",
+  "ReceiptBatch": ".receipt",
+  "read_config": ".config",
+  "set_sink": ".metrics",
+  "sink_from_config": ".metrics",
+  # used to come from `from .parse import *`
+  "BASE_PATH": ".parse",
+  "ORANGE": ".parse",
+  "RESET": ".parse",
+  "STATS_OUTPUT_FORMAT": ".parse",
+  "ParseResult": ".parse",
+  "get_files_in_folder": ".parse",
+  "iter_files_in_folder": ".parse",
+  "output_statistics": ".parse",
+  "percent": ".parse",
+  "read_receipt": ".parse",
+  "parse_many": ".parse",
+  "ocr_receipts": ".parse",
+  "results_to_json": ".parse",
+  "write_json_lines": ".parse",
+  "export_receipts": ".parse",
+}
+
+__all__ = sorted(_LAZY) + ["main"]
+
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
+
+
+def __getattr__(name):
+  if name.startswith("_"):
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+  # everything else also comes from parse, as it did before
+  module = importlib.import_module(_LAZY.get(name, ".parse"), __name__)
+  try:
+    value = getattr(module, name)
+  except AttributeError:
+    raise AttributeError("module %r has no attribute %r" % (__name__, name)) from None
+
+  globals()[name] = value
+  return value
+
 
 def main():
+  import argparse
+  import sys
+
+  from .config import read_config
+  from .metrics import set_sink, sink_from_config
+  from .parse import add_parse_arguments, parse_receipts
+
+  parser = argparse.ArgumentParser(description="OCR and parse receipts")
+  # adds --workers, used by the OCR and the parse step
+  add_parse_arguments(parser)
+  args = parser.parse_args()
+
+  from .enhancer import main as enhance
+  # with --jsonl -, stdout only carries the JSON lines
+  progress = sys.stderr if args.jsonl == "-" else None
+  enhance(workers=args.workers, force=args.force, prune=args.prune, out=progress)
+
   config = read_config()
-  receipt_files = get_files_in_folder(config.receipts_path)
-  stats = ocr_receipts(config, receipt_files)  
+  set_sink(sink_from_config(config))
+  stats = parse_receipts(config, args)
   #output_statistics(stats)
-
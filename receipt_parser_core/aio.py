@@ -0,0 +1,231 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import os
+import threading
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from receipt_parser_core.config import read_config
+from receipt_parser_core.profile import get_profile
+from receipt_parser_core.receipt import Receipt
+
+_parsers = weakref.WeakKeyDictionary()
+_parsers_lock = threading.Lock()
+_default_config = None
+
+
+def _process_image_bytes(config, data):
+    # the image stack is only imported once the first image comes in
+    from receipt_parser_core.enhancer import process_image_bytes
+
+    return process_image_bytes(config, data)
+
+
+class AsyncReceiptParser(object):
+    """ Parses receipts from asyncio code without blocking the event loop """
+
+    def __init__(self, config, max_concurrency=None, queue_size=None, executor=None, timeout=None):
+        """
+        :param config: ObjectView
+            Parsed config file
+        :param max_concurrency: int
+            Number of receipts processed at the same time, defaults to
+            the number of CPU cores
+        :param queue_size: int
+            Number of receipts that may wait for a free slot, defaults
+            to max_concurrency. Callers wait (or get asyncio.QueueFull)
+            while the queue is full.
+        :param executor: concurrent.futures.Executor
+            Executor for the CPU bound work, defaults to a thread pool
+            with max_concurrency threads. With a process pool, the config
+            is sent along with every receipt.
+        :param timeout: float
+            Default timeout per receipt in seconds, None for no limit
+        """
+
+        self.config = config
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.queue_size = self.max_concurrency if queue_size is None else queue_size
+        self.timeout = timeout
+
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        # created on first use, so they belong to the running event loop
+        self._loop = None
+        self._running = None
+        self._admitted = None
+        self._pending = 0
+
+    @property
+    def pending(self):
+        """
+        :return: int
+            Receipts queued or in progress
+        """
+
+        return self._pending
+
+    def _limits(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._running = asyncio.Semaphore(self.max_concurrency)
+            self._admitted = asyncio.Semaphore(self.max_concurrency + self.queue_size)
+        return self._running, self._admitted
+
+    async def _submit(self, function, args, timeout, block):
+        running, admitted = self._limits()
+        if not block and admitted.locked():
+            raise asyncio.QueueFull()
+
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+
+        async with admitted:
+            self._pending += 1
+            try:
+                async with running:
+                    # Cancelling only stops work that has not started yet,
+                    # a receipt already in the executor runs to completion
+                    future = loop.run_in_executor(self.executor, function, *args)
+                    receipt = await asyncio.wait_for(future, timeout)
+            finally:
+                self._pending -= 1
+
+        # receipts from a process pool are pickled without their profile
+        if receipt.profile is None:
+            receipt.profile = get_profile(self.config)
+        return receipt
+
+    async def parse_image(self, data, timeout=None, block=True):
+        """
+        :param data: bytes
+            Encoded receipt image
+        :param timeout: float
+            Seconds to wait for the result, raises asyncio.TimeoutError
+        :param block: bool
+            Wait for room in the queue, or raise asyncio.QueueFull
+        :return: Receipt
+            Enhanced, OCRed and parsed receipt
+        """
+
+        return await self._submit(_process_image_bytes, (self.config, data), timeout, block)
+
+    async def parse_text(self, lines, timeout=None, block=True):
+        """
+        :param lines: [] of str
+            OCRed lines of the receipt
+        :return: Receipt
+            Parsed receipt
+        """
+
+        return await self._submit(Receipt, (self.config, lines), timeout, block)
+
+    async def parse_images(self, images, timeout=None):
+        """
+        :param images: iterable or async iterable of bytes
+            Encoded receipt images
+        :param timeout: float
+            Seconds to wait for each result
+        :return: async generator of Receipt | Exception
+            Results in input order. A failing receipt yields its
+            exception instead of ending the batch. New images are only
+            taken from images while there is room in the queue.
+        """
+
+        window = deque()
+        limit = self.max_concurrency + self.queue_size
+
+        async def results():
+            future = window.popleft()
+            try:
+                return await future
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                return e
+
+        try:
+            async for data in _aiter(images):
+                window.append(asyncio.ensure_future(self.parse_image(data, timeout)))
+                if len(window) >= limit:
+                    yield await results()
+
+            while window:
+                yield await results()
+        finally:
+            for future in window:
+                future.cancel()
+
+    def close(self):
+        """
+        :return: void
+            Shuts down the executor if it was created by the parser
+        """
+
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+
+async def _aiter(items):
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+def get_parser(config=None):
+    """
+    :param config: ObjectView
+        Parsed config file, defaults to config.yml
+    :return: AsyncReceiptParser
+        Shared parser for config
+    """
+
+    global _default_config
+
+    with _parsers_lock:
+        if config is None:
+            if _default_config is None:
+                _default_config = read_config()
+            config = _default_config
+
+        parser = _parsers.get(config)
+        if parser is None:
+            parser = AsyncReceiptParser(config)
+            _parsers[config] = parser
+        return parser
+
+
+async def parse_image(data, config=None, timeout=None):
+    """
+    :param data: bytes
+        Encoded receipt image
+    :param config: ObjectView
+        Parsed config file, defaults to config.yml
+    :param timeout: float
+        Seconds to wait for the result
+    :return: Receipt
+        Parsed receipt
+    """
+
+    return await get_parser(config).parse_image(data, timeout)
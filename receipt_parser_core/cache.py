@@ -0,0 +1,190 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class OcrCache(object):
+    """ Size bounded on-disk LRU cache for raw OCR output """
+
+    def __init__(self, path, max_size=256):
+        """
+        :param path: str
+            Folder to store cached results in
+        :param max_size: int
+            Maximum size of all cached results in MB
+        """
+
+        self.path = path
+        self.max_size = int(max_size * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._lock = threading.Lock()
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self._load()
+
+    def _load(self):
+        entries = []
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".txt"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self.size += size
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + ".txt")
+
+    @staticmethod
+    def key(data, **settings):
+        """
+        :param data: bytes | numpy.ndarray
+            Image data
+        :param settings: {}
+            Everything else the OCR result depends on
+        :return: str
+            Cache key
+        """
+
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(settings, sort_keys=True).encode("utf-8"))
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        :param key: str
+            Cache key
+        :return: str
+            Cached OCR result or None
+        """
+
+        try:
+            with open(self._file(key), encoding="utf-8") as cached:
+                text = cached.read()
+            os.utime(self._file(key))
+        except OSError:
+            with self._lock:
+                self.misses += 1
+                self.size -= self._entries.pop(key, 0)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+
+        return text
+
+    def put(self, key, text):
+        """
+        :param key: str
+            Cache key
+        :param text: str
+            OCR result
+        :return: void
+            Stores the result and evicts the least recently used ones
+        """
+
+        path = self._file(key)
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+
+        tmp_path = path + "." + str(os.getpid()) + "." + str(threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as out:
+            out.write(text)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size -= self._entries.pop(key, 0)
+            self._entries[key] = os.path.getsize(path)
+            self.size += self._entries[key]
+
+            while self.size > self.max_size and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self.size -= old_size
+                try:
+                    os.remove(self._file(old_key))
+                except OSError:
+                    pass
+
+    def stats(self):
+        """
+        :return: {}
+            Hit and miss counters
+        """
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "size": self.size,
+            }
+
+
+def get_cache(path, max_size=256):
+    """
+    :param path: str
+        Folder of the cache
+    :param max_size: int
+        Maximum size in MB
+    :return: OcrCache
+        Process-wide cache for this folder, created on first use
+    """
+
+    path = os.path.abspath(path)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = OcrCache(path, max_size)
+            _caches[path] = cache
+        return cache
+
+
+def cache_for_config(config):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :return: OcrCache
+        Cache configured by ocr_cache_path, None if caching is disabled
+    """
+
+    path = getattr(config, "ocr_cache_path", None)
+    if not path:
+        return None
+
+    return get_cache(path, getattr(config, "ocr_cache_size", 256))
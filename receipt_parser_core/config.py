@@ -1,18 +1,163 @@
+import os
+import re
+import threading
+from types import MappingProxyType
+
 import yaml
 
 from receipt_parser_core.objectview import ObjectView
 
+# Keys every config file needs, and their types. These are the ones the
+# parser reads, so a config for parsing already OCRed text has only these.
+REQUIRED_KEYS = (
+    ("markets", dict),
+    ("sum_keys", list),
+    ("ignore_keys", list),
+    ("sum_format", str),
+    ("item_format", str),
+    ("date_format", str),
+)
 
-def read_config(config="config.yml"):
+# Keys of the OCR and the pipeline, checked by require_keys where they are used
+PIPELINE_KEYS = (
+    ("language", str),
+    ("receipts_path", str),
+)
+
+_configs = {}  # absolute path -> ((mtime, size), FrozenConfig)
+_configs_lock = threading.Lock()
+
+
+class ConfigError(ValueError):
+    """ Raised for config files that can not be used """
+
+
+class FrozenConfig(ObjectView):
+    """ Read-only ObjectView, lists are tuples and dicts are read-only mappings """
+
+    def __init__(self, d):
+        """
+        :param d: {}
+            Object data
+        """
+
+        object.__setattr__(self, "__dict__", {key: _freeze(value) for key, value in d.items()})
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The config is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("The config is read-only")
+
+    def __reduce__(self):
+        # read-only mappings can not be pickled, worker processes get plain data
+        return FrozenConfig, (_thaw(self.__dict__),)
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, (dict, MappingProxyType)):
+        return {key: _thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [_thaw(item) for item in value]
+    return value
+
+
+def validate_config(data, name="config"):
     """
-    :param file: str
-        Name of file to read
-    :return: ObjectView
+    :param data: {}
+        Parsed config file
+    :param name: str
+        Name of the config in error messages
+    :return: void
+        Raises ConfigError if a required key is missing, a key has the
+        wrong type or a pattern does not compile
+    """
+
+    if not isinstance(data, dict):
+        raise ConfigError(name + ": expected a mapping of keys to values")
+
+    for key, kind in REQUIRED_KEYS:
+        if key not in data:
+            raise ConfigError("%s: missing key %r" % (name, key))
+        if not isinstance(data[key], kind):
+            raise ConfigError("%s: %r must be a %s" % (name, key, kind.__name__))
+
+    for key, kind in PIPELINE_KEYS:
+        if key in data and not isinstance(data[key], kind):
+            raise ConfigError("%s: %r must be a %s" % (name, key, kind.__name__))
+
+    for market, spellings in data["markets"].items():
+        if not isinstance(spellings, list) or not all(isinstance(spelling, str) for spelling in spellings):
+            raise ConfigError("%s: the spellings of market %r must be a list of strings" % (name, market))
+
+    for key, value in data.items():
+        if "_format" in key:
+            try:
+                re.compile(value)
+            except (re.error, TypeError) as e:
+                raise ConfigError("%s: %r is not a valid pattern: %s" % (name, key, e)) from None
+
+
+def require_keys(config, *keys):
+    """
+    :param config: ObjectView
         Parsed config file
+    :param keys: str
+        Keys of PIPELINE_KEYS the caller needs
+    :return: void
+        Raises ConfigError if one of them is missing
+    """
+
+    for key in keys:
+        if not hasattr(config, key):
+            raise ConfigError("config: missing key %r, it is needed to OCR or list receipts" % key)
+
+
+def load_config(config="config.yml"):
+    """
+    :param config: str
+        Name of file to read
+    :return: FrozenConfig
+        Parsed and validated config file, read every time
     """
+
     with open(config, 'rb') as stream:
         try:
-            docs = yaml.safe_load(stream)
-            return ObjectView(docs)
+            data = yaml.safe_load(stream)
         except yaml.YAMLError as e:
-            print(e)
+            raise ConfigError("%s: %s" % (config, e)) from None
+
+    validate_config(data, config)
+    return FrozenConfig(data)
+
+
+def read_config(config="config.yml"):
+    """
+    :param config: str
+        Name of file to read
+    :return: FrozenConfig
+        Parsed config file. It is loaded once per process and shared,
+        and loaded again once the file changes.
+    """
+
+    path = os.path.abspath(config)
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+
+    cached = _configs.get(path)
+    if cached is None or cached[0] != version:
+        with _configs_lock:
+            cached = _configs.get(path)
+            if cached is None or cached[0] != version:
+                cached = (version, load_config(path))
+                _configs[path] = cached
+
+    return cached[1]
@@ -14,18 +14,24 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import io
+import argparse
+import logging
 import os
+import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 import cv2
 import numpy as np
 from PIL import Image
-from pytesseract import pytesseract
-from wand.image import Image as WandImage
-from scipy.ndimage import interpolation as inter
 
-from receipt_parser_core import Receipt
-from receipt_parser_core.config import read_config
+from receipt_parser_core.cache import cache_for_config
+from receipt_parser_core.config import read_config, require_keys
+from receipt_parser_core.manifest import manifest_for_config
+from receipt_parser_core.metrics import emit, instrumented, set_sink, sink_from_config
+from receipt_parser_core.ocr import engine_for_config, get_engine, tesseract_version
+from receipt_parser_core.pages import PDF_DPI, document_type, iter_pages, join_pages
+from receipt_parser_core.receipt import Receipt
 
 BASE_PATH = os.getcwd()
 INPUT_FOLDER = os.path.join(BASE_PATH, "data/img")
@@ -35,6 +41,17 @@ OUTPUT_FOLDER = os.path.join(BASE_PATH, "data/txt")
 ORANGE = '\033[33m'
 RESET = '\033[0m'
 
+# Config values the text files in OUTPUT_FOLDER depend on
+OCR_SETTINGS = ("language", "adaptive_enhancement", "grayscale_first", "orientation", "pdf_dpi", "crop_to_document")
+
+# Images narrower than this are upscaled by the adaptive pipeline,
+# about 300 dpi for an 80 mm receipt
+MIN_WIDTH = 950
+
+ImageAssessment = namedtuple("ImageAssessment", ("height", "width", "contrast", "skew", "shadow"))
+
+logger = logging.getLogger(__name__)
+
 
 def prepare_folders():
     """
@@ -54,12 +71,16 @@ def find_images(folder):
     :param folder: str
         Path to folder to search
     :return: generator of str
-        List of images in folder
+        List of images and PDFs in folder
     """
 
     for file in os.listdir(folder):
         full_path = os.path.join(folder, file)
         if os.path.isfile(full_path):
+            if document_type(full_path) == "pdf":
+                yield file
+                continue
+
             try:
                 _ = Image.open(full_path)  # if constructor succeeds
                 yield file
@@ -74,49 +95,163 @@ def rotate_image(input_file, output_file, angle=90):
     :param output_file: str
         Path to output image
     :param angle: float
-        Angle to rotate
+        Angle to rotate clockwise
     :return: void
-        Rotates image and saves result
+        Rotates image unless it is higher than wide and saves result
+    """
+    img = cv2.imread(input_file, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError("Could not read image: " + input_file)
+
+    height, width = img.shape[:2]
+    if width < height:
+        angle = 0
+
+    logger.debug("Rotate image by: %s°", angle)
+    if angle % 90 == 0:
+        img = rotate_upright(img, angle)
+    else:
+        # grow the canvas so no corner is cut off
+        M = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+        cos, sin = abs(M[0, 0]), abs(M[0, 1])
+        size = (int(height * sin + width * cos + 0.5), int(height * cos + width * sin + 0.5))
+        M[0, 2] += size[0] / 2 - width / 2
+        M[1, 2] += size[1] / 2 - height / 2
+        img = cv2.warpAffine(img, M, size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_CONSTANT,
+                             borderValue=(255, 255, 255, 255))
+
+    cv2.imwrite(output_file, img)
+
+
+_ROTATIONS = {
+    90: cv2.ROTATE_90_CLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_COUNTERCLOCKWISE,
+}
+
+
+def rotate_upright(img, angle):
+    """
+    :param img: numpy.ndarray
+        Image to rotate
+    :param angle: int
+        Clockwise rotation in degrees, a multiple of 90
+    :return: numpy.ndarray
+        Rotated image, pixels are moved without interpolation
+    """
+    angle %= 360
+    if not angle:
+        return img
+
+    return cv2.rotate(img, _ROTATIONS[angle])
+
+
+@instrumented("rotate_landscape")
+def rotate_landscape(img):
+    """
+    :param img: numpy.ndarray
+        Image to rotate
+    :return: numpy.ndarray
+        Image rotated clockwise by 90° if it is wider than high
+    """
+    height, width = img.shape[:2]
+    angle = 90 if width > height else 0
+
+    logger.debug("Rotate image by: %s°", angle)
+    if angle:
+        img = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+
+    return img
+
+
+def _skew_scores(ys, xs, angles, bins):
+    """
+    Projection profile score of the foreground pixels for every angle at once:
+    the row index of each pixel after rotating it, summed up per row.
+    """
+    theta = np.deg2rad(angles)[:, None]
+    rows = np.rint(ys * np.cos(theta) - xs * np.sin(theta)).astype(np.int64) + bins // 2
+    np.clip(rows, 0, bins - 1, out=rows)
+    rows += (np.arange(len(angles)) * bins)[:, None]
+
+    histograms = np.bincount(rows.ravel(), minlength=len(angles) * bins)
+    histograms = histograms.reshape(len(angles), bins).astype(np.float64)
+
+    return np.sum(np.diff(histograms, axis=1) ** 2, axis=1)
+
+
+def estimate_skew(image, limit=5, precision=0.1, max_size=1000):
+    """
+    :param image: numpy.ndarray
+        Color or grayscale image
+    :param limit: float
+        Largest skew angle to look for, in both directions
+    :param precision: float
+        Precision of the returned angle
+    :param max_size: int
+        The image is downscaled to this size before searching
+    :return: float
+        Angle to rotate the image by to deskew it
     """
-    with WandImage(filename=input_file) as img:
-        width, height = img.size
-        if width < height:
-            angle = 0
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-        print(ORANGE + '\t~: ' + RESET + 'Rotate image by: ' + str(angle) + "°" + RESET)
-        with img.clone() as rotated:
-            rotated.rotate(angle)
-            rotated.save(filename=output_file)
+    scale = max_size / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-def deskew_image(image, delta=1, limit=5):
-    def determine_score(arr, angle):
-        data = inter.rotate(arr, angle, reshape=False, order=0)
-        histogram = np.sum(data, axis=1)
-        score = np.sum((histogram[1:] - histogram[:-1]) ** 2)
-        return histogram, score
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1] 
+    (h, w) = thresh.shape
+    ys, xs = np.nonzero(thresh)
+    if not len(ys):
+        return 0.0
 
-    scores = []
-    angles = np.arange(-limit, limit + delta, delta)
-    for angle in angles:
-        histogram, score = determine_score(thresh, angle)
-        scores.append(score)
+    ys = ys.astype(np.float32) - h / 2
+    xs = xs.astype(np.float32) - w / 2
+    bins = int(np.hypot(h, w)) + 2
 
-    best_angle = angles[scores.index(max(scores))]
+    # coarse search in 1° steps, then refine around the best angle
+    step = 1.0
+    angles = np.arange(-limit, limit + step / 2, step)
+    best_angle = angles[np.argmax(_skew_scores(ys, xs, angles, bins))]
+
+    while step > precision + 1e-9:
+        fine_step = max(step / 10, precision)
+        angles = np.arange(best_angle - step, best_angle + step + fine_step / 2, fine_step)
+        best_angle = angles[np.argmax(_skew_scores(ys, xs, angles, bins))]
+        step = fine_step
+
+    return round(float(best_angle), 3) + 0.0
+
+
+@instrumented("deskew_image")
+def deskew_image(image, delta=0.1, limit=5, angle=None):
+    """
+    :param image: numpy.ndarray
+        Image to deskew
+    :param delta: float
+        Precision of the skew angle
+    :param limit: float
+        Largest skew angle to correct
+    :param angle: float
+        Skew angle if it is already known, estimated otherwise
+    :return: numpy.ndarray
+        Deskewed image
+    """
+    best_angle = estimate_skew(image, limit, delta) if angle is None else angle
 
     (h, w) = image.shape[:2]
     center = (w // 2, h // 2)
     M = cv2.getRotationMatrix2D(center, best_angle, 1.0)
 
-    print(ORANGE + '\t~: ' + RESET + 'Deskew image by: ' + str(best_angle) + ' angle' + RESET)
+    logger.debug("Deskew image by: %s°", best_angle)
 
     rotated = cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_CUBIC, \
               borderMode=cv2.BORDER_REPLICATE)
 
     return rotated
 
+
 def run_tesseract(input_file, output_file, language="deu"):
     """
     :param input_file: str
@@ -127,41 +262,53 @@ def run_tesseract(input_file, output_file, language="deu"):
         Runs tesseract on image and saves result
     """
 
-    print(ORANGE + '\t~: ' + RESET + 'Parse image using pytesseract' + RESET)
-    print(ORANGE + '\t~: ' + RESET + 'Parse image at: ' + input_file + RESET)
-    print(ORANGE + '\t~: ' + RESET + 'Write result to: ' + output_file + RESET)
+    logger.debug("Parse image at: %s, write result to: %s", input_file, output_file)
+
+    with Image.open(input_file) as img:
+        image_data = ocr_image(img, language)
+
+    with open(output_file, "w", encoding='utf-8') as out:
+        out.write(image_data)
 
-    with io.BytesIO() as transfer:
-        with WandImage(filename=input_file) as img:
-            img.save(transfer)
 
-        with Image.open(transfer) as img:
-            image_data = pytesseract.image_to_string(img, lang=language, timeout=60, config="--psm 6")
+@instrumented("ocr_image")
+def ocr_image(img, language="deu", engine=None, psm=6):
+    """
+    :param img: numpy.ndarray | PIL.Image.Image
+        Image to OCR, numpy arrays are expected in OpenCV (BGR) channel order
+    :param language: str
+        Tesseract language
+    :param engine: OcrEngine
+        Engine to run tesseract on, defaults to an in-process engine
+    :param psm: int
+        Tesseract page segmentation mode
+    :return: str
+        Text found in image
+    """
+
+    if isinstance(img, np.ndarray) and img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
 
-            out = open(output_file, "w", encoding='utf-8')
-            out.write(image_data)
-            out.close()
+    if engine is None:
+        engine = get_engine(language)
 
+    return engine.image_to_string(img, psm)
 
-def rescale_image(img):
-    print(ORANGE + '\t~: ' + RESET + 'Rescale image' + RESET)
-    img = cv2.resize(img, None, fx=1.2, fy=1.2, interpolation=cv2.INTER_CUBIC)
+
+@instrumented("rescale_image")
+def rescale_image(img, factor=1.2):
+    img = cv2.resize(img, None, fx=factor, fy=factor, interpolation=cv2.INTER_CUBIC)
     return img
 
 
+@instrumented("grayscale_image")
 def grayscale_image(img):
-    print(ORANGE + '\t~: ' + RESET + 'Grayscale image' + RESET)
     img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     return img
 
 
+@instrumented("remove_noise")
 def remove_noise(img):
-    kernel = np.ones((1, 1), np.uint8)
-    img = cv2.dilate(img, kernel, iterations=1)
-    img = cv2.erode(img, kernel, iterations=1)
-
-    print(ORANGE + '\t~: ' + RESET + 'Applying gaussianBlur and medianBlur' + RESET)
-
     img = cv2.threshold(cv2.GaussianBlur(img, (5, 5), 0), 150, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
     img = cv2.threshold(cv2.bilateralFilter(img, 5, 75, 75), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
     img = cv2.adaptiveThreshold(cv2.bilateralFilter(img, 9, 75, 75), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
@@ -170,44 +317,452 @@ def remove_noise(img):
     return img
 
 
+def _remove_plane_shadows(plane):
+    dilated_img = cv2.dilate(plane, np.ones((7, 7), np.uint8))
+    bg_img = cv2.medianBlur(dilated_img, 21)
+    return 255 - cv2.absdiff(plane, bg_img)
+
+
+@instrumented("remove_shadows")
 def remove_shadows(img):
-    rgb_planes = cv2.split(img)
+    """
+    :param img: numpy.ndarray
+        Color or grayscale image
+    :return: numpy.ndarray
+        Image with the background brightness evened out, every channel
+        on its own
+    """
+    if img.ndim == 2:
+        return _remove_plane_shadows(img)
+
+    return cv2.merge([_remove_plane_shadows(plane) for plane in cv2.split(img)])
+
+
+def text_is_vertical(image, max_size=1000, chunk_size=500):
+    """
+    :param image: numpy.ndarray
+        Color or grayscale image
+    :param max_size: int
+        The image is downscaled to this size before measuring
+    :param chunk_size: int
+        Letters whose nearest neighbour is searched at once
+    :return: bool
+        True iff the text lines run from top to bottom: the nearest
+        neighbour of most letters is above or below them, not next to
+        them. Letters are closer to each other than lines are, whatever
+        the aspect ratio of the image or the columns of the text.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
-    result_planes = []
-    result_norm_planes = []
-    for plane in rgb_planes:
-        dilated_img = cv2.dilate(plane, np.ones((7,7), np.uint8))
-        bg_img = cv2.medianBlur(dilated_img, 21)
-        diff_img = 255 - cv2.absdiff(plane, bg_img)
-        norm_img = cv2.normalize(diff_img,None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_8UC1)
-        result_planes.append(diff_img)
-        result_norm_planes.append(norm_img)
+    scale = max_size / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
 
-    result = cv2.merge(result_planes)
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
 
-    return result
+    _, _, stats, centroids = cv2.connectedComponentsWithStats(thresh)
+    sizes = np.maximum(stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT])
+    if not len(sizes):
+        return False
 
+    # letters only, no specks, punctuation, lines or logos
+    size = np.median(sizes)
+    letters = centroids[1:][(sizes >= max(3, size / 2)) & (sizes <= 3 * size)]
 
-def detect_orientation(image):
-    coords = np.column_stack(np.where(image > 0))
-    angle = cv2.minAreaRect(coords)[-1]
-    print(ORANGE + '\t~: ' + RESET + 'Get rotation angle:' + str(angle) + RESET)
+    horizontal = vertical = 0
+    for start in range(0, len(letters), chunk_size):
+        chunk = letters[start:start + chunk_size]
+        offsets = chunk[:, None, :] - letters[None, :, :]
+        distances = np.hypot(offsets[..., 0], offsets[..., 1])
+        distances[np.arange(len(chunk)), np.arange(start, start + len(chunk))] = np.inf
 
-    return image
+        nearest = np.abs(offsets[np.arange(len(chunk)), np.argmin(distances, axis=1)])
+        horizontal += np.count_nonzero(nearest[:, 0] > nearest[:, 1])
+        vertical += np.count_nonzero(nearest[:, 1] > nearest[:, 0])
 
+    return vertical > horizontal
+
+
+def text_is_upside_down(image, max_size=1000, min_alignment=0.05):
+    """
+    :param image: numpy.ndarray
+        Color or grayscale image with horizontal text lines
+    :param max_size: int
+        The image is downscaled to this size before measuring
+    :param min_alignment: float
+        Difference between the alignment of the letter tops and bottoms,
+        relative to the letter height, a line needs to vote with it
+    :return: bool
+        True iff the text is upside down. The letters of a line share
+        their baseline, while their tops end at the x-height or the cap
+        height. Lines in capitals vote with their periods and commas
+        instead, which sit on the baseline.
+    """
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    scale = max_size / max(gray.shape)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    (h, w) = gray.shape
+    angle = estimate_skew(gray)
+    # a slight skew blurs the letter edges more than it moves them
+    if abs(angle) >= 0.5:
+        M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
+        gray = cv2.warpAffine(gray, M, (w, h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+
+    stats = cv2.connectedComponentsWithStats(thresh)[2][1:]
+    tops, widths, heights = stats[:, cv2.CC_STAT_TOP], stats[:, cv2.CC_STAT_WIDTH], stats[:, cv2.CC_STAT_HEIGHT]
+    bottoms = tops + heights
+    centers = tops + heights / 2
+
+    # text lines are the runs of rows with ink
+    rows = np.count_nonzero(thresh, axis=1) > 0.01 * w
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], rows.view(np.int8), [0]))))
+
+    votes = 0
+    for start, end in edges.reshape(-1, 2):
+        line = (centers >= start) & (centers < end)
+        height = np.median(heights[line]) if line.any() else 0
+        letters = line & (heights >= 0.6 * height) & (heights <= 2 * height)
+        if height < 4 or np.count_nonzero(letters) < 4:
+            continue
+
+        top, bottom = np.median(tops[letters]), np.median(bottoms[letters])
+        alignment = np.mean(np.abs(tops[letters] - top)) - np.mean(np.abs(bottoms[letters] - bottom))
+        if abs(alignment) >= min_alignment * height:
+            votes += np.sign(alignment)
+            continue
+
+        marks = line & (heights < 0.35 * height) & (widths < 0.6 * height)
+        low = np.count_nonzero(centers[marks] > bottom - 0.3 * height)
+        high = np.count_nonzero(centers[marks] < top + 0.3 * height)
+        votes += np.sign(low - high)
+
+    return votes < 0
+
+
+def detect_orientation(image, method="projection", min_confidence=2.0):
+    """
+    :param image: numpy.ndarray
+        Color or grayscale image
+    :param method: str
+        "projection" turns vertical text lines clockwise, then turns
+        them by 180° if the text is upside down, see text_is_upside_down.
+        "osd" asks tesseract's orientation detection and falls back to
+        projection if it fails or is unsure. "landscape" turns images
+        clockwise that are wider than high.
+    :param min_confidence: float
+        OSD results with a lower confidence are not trusted
+    :return: int
+        Clockwise rotation in degrees that makes the text upright
+    """
+    if method == "landscape":
+        height, width = image.shape[:2]
+        return 90 if width > height else 0
+
+    if method == "osd":
+        try:
+            img = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+            angle, confidence = get_engine("osd").orientation(img)
+            if confidence >= min_confidence:
+                return angle
+            logger.debug("Orientation detection unsure (%.2f), using projection profiles", confidence)
+        except Exception as e:
+            logger.debug("Orientation detection failed, using projection profiles: %s", e)
+
+    elif method != "projection":
+        raise ValueError("Unknown orientation detection method: " + str(method))
+
+    angle = 90 if text_is_vertical(image) else 0
+    if text_is_upside_down(rotate_upright(image, angle)):
+        angle += 180
+
+    return angle
+
+
+@instrumented("orient_image")
+def orient_image(img, method="projection"):
+    """
+    :param img: numpy.ndarray
+        Image to rotate
+    :param method: str
+        Orientation detection method, see detect_orientation
+    :return: numpy.ndarray
+        Image with upright text
+    """
+    angle = detect_orientation(img, method)
+
+    logger.debug("Rotate image by: %s°", angle)
+    return rotate_upright(img, angle)
+
+
+def _orientation_method(rotate):
+    return "projection" if rotate is True else rotate
+
+
+class EnhancementPlan(namedtuple("EnhancementPlan", ("scale", "skew", "remove_shadows", "remove_noise"))):
+    """ Stages the adaptive pipeline runs on an image """
+
+    __slots__ = ()
+
+    def __str__(self):
+        stages = []
+        if self.scale != 1.0:
+            stages.append("rescale %.2fx" % self.scale)
+        if self.skew:
+            stages.append("deskew %.1f°" % self.skew)
+        if self.remove_shadows:
+            stages.append("remove shadows")
+        if self.remove_noise:
+            stages.append("remove noise")
+
+        return ", ".join(stages) or "clean"
+
+
+def _order_corners(points):
+    # top left, top right, bottom right, bottom left
+    points = points.reshape(4, 2).astype(np.float32)
+    sums, diffs = points.sum(axis=1), np.diff(points, axis=1).ravel()
+
+    return np.array([
+        points[sums.argmin()], points[diffs.argmin()], points[sums.argmax()], points[diffs.argmax()]
+    ], np.float32)
+
+
+@instrumented("crop_to_document")
+def crop_to_document(img, perspective=False, max_size=500, min_area=0.1, max_area=0.9, min_solidity=0.9,
+                     margin=0.01):
+    """
+    :param img: numpy.ndarray
+        Color or grayscale photo of a receipt
+    :param perspective: bool
+        Warp the receipt to a rectangle if its four corners are found,
+        instead of cropping to its bounding box
+    :param max_size: int
+        The receipt is searched on a proxy downscaled to this size
+    :param min_area: float
+        Smallest part of the image the receipt may cover
+    :param max_area: float
+        Images the receipt covers more of are not cropped
+    :param min_solidity: float
+        Bright regions that fill less of their convex hull are not paper
+    :param margin: float
+        Border kept around the receipt, relative to the image size
+    :return: numpy.ndarray
+        The receipt paper, or img if it can't be told from the background
+    """
+    height, width = img.shape[:2]
+
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = min(1.0, max_size / max(height, width))
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    # the paper is brighter than the background, closing fills in the text
+    gray = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, np.ones((9, 9), np.uint8))
+
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return img
+
+    contour = max(contours, key=cv2.contourArea)
+    hull = cv2.convexHull(contour)
+    area = cv2.contourArea(contour)
+    if not min_area <= area / mask.size <= max_area or area < min_solidity * cv2.contourArea(hull):
+        return img
+
+    pad = margin * max(height, width)
+    if perspective:
+        corners = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+        if len(corners) == 4:
+            corners = _order_corners(corners) / scale
+            # move the corners outwards by the margin
+            outwards = corners - corners.mean(axis=0)
+            corners += outwards / np.linalg.norm(outwards, axis=1, keepdims=True) * pad
+
+            top_left, top_right, bottom_right, bottom_left = corners
+            size = (
+                int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left))),
+                int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right))),
+            )
+            target = np.array([[0, 0], [size[0] - 1, 0], [size[0] - 1, size[1] - 1], [0, size[1] - 1]], np.float32)
+
+            transform = cv2.getPerspectiveTransform(corners, target)
+            return cv2.warpPerspective(img, transform, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+    x, y, w, h = cv2.boundingRect(hull)
+    x0, y0 = max(0, int(x / scale - pad)), max(0, int(y / scale - pad))
+    x1, y1 = min(width, int((x + w) / scale + pad)), min(height, int((y + h) / scale + pad))
+
+    return img[y0:y1, x0:x1]
+
+
+@instrumented("assess_image")
+def assess_image(img, max_size=1000):
+    """
+    :param img: numpy.ndarray
+        Color or grayscale image
+    :param max_size: int
+        Everything is measured on a proxy downscaled to this size
+    :return: ImageAssessment
+        Size, contrast (0-1), skew angle and shadow strength (0-1,
+        the spread of the estimated background brightness)
+    """
+    height, width = img.shape[:2]
+
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    scale = max_size / max(height, width)
+    if scale < 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    low, high = np.percentile(gray, (5, 95))
+
+    # same background estimate as remove_shadows
+    background = cv2.medianBlur(cv2.dilate(gray, np.ones((7, 7), np.uint8)), 21)
+    background_low, background_high = np.percentile(background, (5, 95))
+
+    return ImageAssessment(
+        height, width, float(high - low) / 255, estimate_skew(gray, max_size=max_size),
+        float(background_high - background_low) / 255
+    )
+
+
+def plan_enhancement(assessment, gaussian_blur=True, min_width=MIN_WIDTH, skew_tolerance=0.5,
+                     shadow_tolerance=0.15, clean_contrast=0.6):
+    """
+    :param assessment: ImageAssessment
+        Measurements of the image
+    :param gaussian_blur: bool
+        Remove noise, unless the image is clean anyway
+    :param min_width: int
+        Narrower images are upscaled, by at most 2x
+    :param skew_tolerance: float
+        Smaller skew angles are not corrected
+    :param shadow_tolerance: float
+        Weaker shadows are not removed
+    :param clean_contrast: float
+        Images with at least this contrast and no shadows are clean
+    :return: EnhancementPlan
+        Stages needed for the image
+    """
+
+    width = min(assessment.height, assessment.width)
+    scale = min(2.0, min_width / width) if width < min_width else 1.0
+
+    skew = assessment.skew if abs(assessment.skew) >= skew_tolerance else 0.0
+    shadows = assessment.shadow >= shadow_tolerance
+    noise = gaussian_blur and (shadows or assessment.contrast < clean_contrast)
+
+    return EnhancementPlan(scale, skew, shadows, noise)
+
+
+def _skipped(stage, img):
+    emit(stage, 0.0, img.shape, "skipped")
+
+
+@instrumented("enhance_adaptive")
+def enhance_adaptive(img, high_contrast=True, gaussian_blur=True, rotate=True, grayscale_first=False, crop=False):
+    """
+    :param img: numpy.ndarray
+        Image to enhance
+    :param grayscale_first: bool
+        Convert to grayscale before all other stages, see enhance_image
+    :param crop: bool | str
+        Crop to the receipt first, see enhance_image
+    :return: (numpy.ndarray, EnhancementPlan)
+        Enhanced image and the stages that were run on it. Only the
+        stages the assessment of the image calls for are run, skipped
+        stages are reported with the outcome "skipped".
+    """
+    if crop:
+        img = crop_to_document(img, crop == "perspective")
+
+    if high_contrast and grayscale_first:
+        img = grayscale_image(img)
+
+    if rotate:
+        img = orient_image(img, _orientation_method(rotate))
+
+    plan = plan_enhancement(assess_image(img), gaussian_blur)
+    logger.info("Enhance %s image: %s", "x".join(map(str, img.shape[:2])), plan)
+
+    if plan.scale != 1.0:
+        img = rescale_image(img, plan.scale)
+    else:
+        _skipped("rescale_image", img)
+
+    if plan.skew:
+        img = deskew_image(img, angle=plan.skew)
+    else:
+        _skipped("deskew_image", img)
+
+    if plan.remove_shadows:
+        img = remove_shadows(img)
+    else:
+        _skipped("remove_shadows", img)
+
+    if high_contrast and not grayscale_first:
+        img = grayscale_image(img)
+
+    if plan.remove_noise:
+        img = remove_noise(img)
+    else:
+        _skipped("remove_noise", img)
+
+    return img, plan
+
+
+@instrumented("enhance_image")
+def enhance_image(img, tmp_path=None, high_contrast=True, gaussian_blur=True, rotate=True, adaptive=False,
+                  grayscale_first=False, crop=False):
+    """
+    :param img: numpy.ndarray
+        Image to enhance
+    :param tmp_path: str
+        Unused, images are no longer written to disk while enhancing
+    :param high_contrast: bool
+        Convert to grayscale
+    :param gaussian_blur: bool
+        Remove noise
+    :param rotate: bool | str
+        Turn the text upright, True or an orientation detection method,
+        see detect_orientation
+    :param adaptive: bool
+        Only run the stages the image needs, see enhance_adaptive
+    :param grayscale_first: bool
+        Convert to grayscale before all other stages, so they work on one
+        channel instead of three. Shadows are then removed from the
+        brightness instead of every color channel, the OCR input is
+        nearly the same.
+    :param crop: bool | str
+        Crop photos to the receipt paper before all other stages, so they
+        don't process the background. "perspective" also warps the
+        receipt to a rectangle, see crop_to_document
+    :return: numpy.ndarray
+        Enhanced image
+    """
+    if adaptive:
+        return enhance_adaptive(img, high_contrast, gaussian_blur, rotate, grayscale_first, crop)[0]
+
+    if crop:
+        img = crop_to_document(img, crop == "perspective")
+
+    if high_contrast and grayscale_first:
+        img = grayscale_image(img)
 
-def enhance_image(img, tmp_path ,high_contrast=True, gaussian_blur=True, rotate=True): 
     img = rescale_image(img)
 
     if rotate:
-        cv2.imwrite(tmp_path, img)
-        rotate_image(tmp_path, tmp_path)
-        img = cv2.imread(tmp_path)
+        img = orient_image(img, _orientation_method(rotate))
 
     img = deskew_image(img)
     img = remove_shadows(img)
 
-    if high_contrast:
+    if high_contrast and not grayscale_first:
         img = grayscale_image(img)
 
     if gaussian_blur:
@@ -216,73 +771,415 @@ def enhance_image(img, tmp_path ,high_contrast=True, gaussian_blur=True, rotate=
     return img
 
 
+def ocr_cache_key(cache, data, language, rotate=True, grayscale=True, gaussian_blur=True, adaptive=False,
+                  grayscale_first=False, crop=False, **settings):
+    """
+    :param cache: OcrCache
+        Cache to build the key for
+    :param data: bytes | numpy.ndarray
+        Image file contents or decoded image
+    :return: str
+        Cache key covering the image and every setting the OCR text depends on
+    """
+
+    # keys of the default pipeline stay as they were
+    if adaptive:
+        settings["adaptive"] = True
+    if grayscale_first:
+        settings["grayscale_first"] = True
+    if crop:
+        settings["crop"] = "perspective" if crop == "perspective" else True
+
+    return cache.key(
+        data, language=language, rotate=_orientation_method(rotate), grayscale=grayscale,
+        gaussian_blur=gaussian_blur, tesseract=tesseract_version(), **settings
+    )
+
+
+@instrumented("process_image", shape=lambda config, img, *args, **kwargs: img.shape)
+def process_image(config, img, rotate=True, grayscale=True, gaussian_blur=True):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param img: numpy.ndarray
+        Image of the receipt, as returned by cv2.imread
+    :return: (str, Receipt)
+        Enhances and OCRs the image in memory, returns the text and
+        the parsed receipt
+    """
+
+    raw = _image_text(config, img, rotate, grayscale, gaussian_blur)
+    return raw, Receipt(config=config, raw=raw.splitlines(keepends=True))
+
+
+def _image_text(config, img, rotate=True, grayscale=True, gaussian_blur=True):
+    require_keys(config, "language")
+    adaptive = getattr(config, "adaptive_enhancement", False)
+    grayscale_first = getattr(config, "grayscale_first", False)
+    crop = getattr(config, "crop_to_document", False)
+    if rotate is True:
+        rotate = getattr(config, "orientation", True)
+
+    raw, key = None, None
+    cache = cache_for_config(config)
+    if cache is not None:
+        img = np.ascontiguousarray(img)
+        key = ocr_cache_key(cache, img, config.language, rotate, grayscale, gaussian_blur, adaptive,
+                            grayscale_first, crop, shape=list(img.shape))
+        raw = cache.get(key)
+
+    if raw is None:
+        img = enhance_image(img, None, grayscale, gaussian_blur, rotate, adaptive, grayscale_first, crop)
+        raw = ocr_image(img, config.language, engine_for_config(config))
+
+        if cache is not None:
+            cache.put(key, raw)
+
+    return raw
+
+
+def process_pages(config, pages, rotate=True, grayscale=True, gaussian_blur=True):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param pages: iterable of numpy.ndarray
+        Images of the pages of one receipt, see pages.iter_pages
+    :return: (str, Receipt)
+        Enhances and OCRs the pages one after the other, returns the
+        text of all pages and the receipt parsed from it
+    """
+
+    raw = join_pages(_image_text(config, page, rotate, grayscale, gaussian_blur) for page in pages)
+    return raw, Receipt(config=config, raw=raw.splitlines(keepends=True))
+
+
+def process_image_bytes(config, data, rotate=True, grayscale=True, gaussian_blur=True):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param data: bytes
+        Encoded image, in any format OpenCV can read, or a PDF or TIFF
+        with one or more pages
+    :return: Receipt
+        Parsed receipt
+    """
+
+    if document_type(data):
+        pages = iter_pages(data, getattr(config, "pdf_dpi", PDF_DPI))
+        return process_pages(config, pages, rotate, grayscale, gaussian_blur)[1]
+
+    img = None
+    if data:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    return process_image(config, img, rotate, grayscale, gaussian_blur)[1]
+
+
 def process_receipt(config, filename, rotate=True, grayscale=True, gaussian_blur=True):
     input_path = INPUT_FOLDER + "/" + filename
 
     output_path = OUTPUT_FOLDER + "/" + filename.split(".")[0] + ".txt"
 
-    print(ORANGE + '~: ' + RESET + 'Process image: ' + ORANGE + input_path + RESET)
+    logger.info("Process image: %s", input_path)
     prepare_folders()
 
-    try:
+    if document_type(input_path):
+        pages = iter_pages(input_path, getattr(config, "pdf_dpi", PDF_DPI))
+        raw, receipt = process_pages(config, pages, rotate, grayscale, gaussian_blur)
+    else:
         img = cv2.imread(input_path)
-    except FileNotFoundError:
-        return Receipt(config=config, raw="")
+        if img is None:
+            return Receipt(config=config, raw="")
 
-    tmp_path = os.path.join(
-        TMP_FOLDER, filename
-    )
-    img = enhance_image(img, tmp_path,grayscale, gaussian_blur)
+        raw, receipt = process_image(config, img, rotate, grayscale, gaussian_blur)
 
-    print(ORANGE + '~: ' + RESET + 'Temporary store image at: ' + ORANGE + tmp_path + RESET)
+    logger.info("Store parsed text at: %s", output_path)
+    with open(output_path, "w", encoding='utf-8') as out:
+        out.write(raw)
 
-    cv2.imwrite(tmp_path, img)
-    run_tesseract(tmp_path, output_path, config.language)
+    return receipt
 
-    print(ORANGE + '~: ' + RESET + 'Store parsed text at: ' + ORANGE + output_path + RESET)
-    raw = open(output_path, 'r', encoding='utf-8').readlines()
 
-    return Receipt(config=config, raw=raw)
+def _read_image(image):
+    input_path = os.path.join(INPUT_FOLDER, image)
 
+    img = cv2.imread(input_path)
+    if img is None:
+        raise ValueError("Could not read image: " + input_path)
 
-def main():
+    return img
+
+
+def _read_pages(image, dpi=PDF_DPI):
+    input_path = os.path.join(INPUT_FOLDER, image)
+    if document_type(input_path):
+        return iter_pages(input_path, dpi)
+
+    return iter([_read_image(image)])
+
+
+def _ocr_pages(pages, language, adaptive=False, grayscale_first=False, rotate=True, crop=False, engine=None):
+    """
+    :return: (str, EnhancementPlan | [] of EnhancementPlan)
+        Text and plan of a single page, or the text of all pages and
+        the plan of every page
+    """
+
+    texts, plans = [], []
+    for img in pages:
+        plan = None
+        if adaptive:
+            img, plan = enhance_adaptive(img, rotate=rotate, grayscale_first=grayscale_first, crop=crop)
+        else:
+            img = enhance_image(img, rotate=rotate, grayscale_first=grayscale_first, crop=crop)
+
+        texts.append(ocr_image(img, language, engine))
+        plans.append(plan)
+        # drop the page before the next one is read
+        del img
+
+    if len(texts) == 1:
+        return texts[0], plans[0]
+
+    return join_pages(texts), plans if adaptive else None
+
+
+def ocr_image_file(image, language="deu", adaptive=False, grayscale_first=False, rotate=True, dpi=PDF_DPI,
+                   crop=False, engine=None):
+    """
+    :param image: str
+        Name of image or document in INPUT_FOLDER
+    :param language: str
+        Tesseract language
+    :param adaptive: bool
+        Only run the enhancement stages the image needs
+    :param grayscale_first: bool
+        Run the enhancement stages on one channel
+    :param rotate: bool | str
+        Orientation detection method, see enhance_image
+    :param dpi: int
+        Resolution PDF pages are rasterized at
+    :param crop: bool | str
+        Crop to the receipt paper first, see enhance_image
+    :param engine: OcrEngine
+        Engine to run tesseract on, defaults to an in-process engine
+    :return: str
+        Enhances and OCRs a single image, or every page of a document,
+        returns the text
+    """
+
+    return _ocr_pages(_read_pages(image, dpi), language, adaptive, grayscale_first, rotate, crop, engine)[0]
+
+
+def _ocr_image_task(image, language, adaptive=False, grayscale_first=False, rotate=True, dpi=PDF_DPI, crop=False,
+                    engine=None):
+    """
+    Process pool task: never raises, so one broken receipt can't abort the batch.
+    """
+
+    try:
+        text, plan = _ocr_pages(_read_pages(image, dpi), language, adaptive, grayscale_first, rotate, crop, engine)
+        return image, text, plan, None
+    except Exception as e:
+        return image, None, None, type(e).__name__ + ": " + str(e)
+
+
+def _run_ocr_tasks(images, language, workers, engine=None, adaptive=False, grayscale_first=False, rotate=True,
+                   dpi=PDF_DPI, crop=False):
+    if workers == 1 or len(images) <= 1:
+        return [
+            _ocr_image_task(image, language, adaptive, grayscale_first, rotate, dpi, crop, engine) for image in images
+        ]
+
+    results = []
+    # the engine is pickled as its settings, every worker uses its own
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        futures = [
+            executor.submit(_ocr_image_task, image, language, adaptive, grayscale_first, rotate, dpi, crop, engine)
+            for image in images
+        ]
+
+        for image, future in zip(images, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:  # worker process died
+                results.append((image, None, None, type(e).__name__ + ": " + str(e)))
+
+    return results
+
+
+def _store_text(image, text):
+    out_path = os.path.join(OUTPUT_FOLDER, image + ".txt")
+    with open(out_path, "w", encoding='utf-8') as out:
+        out.write(text)
+
+    return image, out_path, None
+
+
+def ocr_images(images, language="deu", workers=None, engine=None, cache=None, adaptive=False, plans=None,
+               grayscale_first=False, rotate=True, dpi=PDF_DPI, crop=False):
+    """
+    :param images: [] of str
+        Names of images and documents in INPUT_FOLDER
+    :param language: str
+        Tesseract language
+    :param workers: int
+        Number of worker processes, None or 0 for one per CPU core
+    :param engine: OcrEngine
+        Engine to run tesseract on, see engine_for_config. Its pool size
+        and memory limit apply to every worker process.
+    :param cache: OcrCache
+        Cache for OCR results, images found in it are not processed again
+    :param adaptive: bool
+        Only run the enhancement stages each image needs
+    :param plans: {}
+        Filled with the EnhancementPlan of every image the adaptive
+        pipeline processed, a list of them for multi-page documents
+    :param grayscale_first: bool
+        Run the enhancement stages on one channel
+    :param rotate: bool | str
+        Orientation detection method, see enhance_image
+    :param dpi: int
+        Resolution PDF pages are rasterized at
+    :param crop: bool | str
+        Crop to the receipt paper first, see enhance_image
+    :return: [] of (str, str, str)
+        Image name, path to text file (None on failure) and error
+        message (None on success), in the same order as images
+    """
+
+    images = list(images)
+    results = [None] * len(images)
+    keys = [None] * len(images)
+
+    pending = []
+    for i, image in enumerate(images):
+        if cache is not None:
+            try:
+                with open(os.path.join(INPUT_FOLDER, image), "rb") as image_file:
+                    data = image_file.read()
+                # keys of images stay as they were, only PDFs depend on the dpi
+                settings = {"dpi": dpi} if document_type(data) == "pdf" else {}
+                keys[i] = ocr_cache_key(cache, data, language, rotate, adaptive=adaptive,
+                                        grayscale_first=grayscale_first, crop=crop, **settings)
+            except OSError:
+                pending.append(i)  # let the worker report the error
+                continue
+
+            text = cache.get(keys[i])
+            if text is not None:
+                results[i] = _store_text(image, text)
+                continue
+
+        pending.append(i)
+
+    tasks = _run_ocr_tasks([images[i] for i in pending], language, workers, engine, adaptive, grayscale_first,
+                           rotate, dpi, crop)
+    for i, (image, text, plan, error) in zip(pending, tasks):
+        if plans is not None and plan is not None:
+            plans[image] = plan
+
+        if error:
+            results[i] = (image, None, error)
+            continue
+
+        if keys[i] is not None:
+            cache.put(keys[i], text)
+        results[i] = _store_text(image, text)
+
+    return results
+
+
+def main(workers=None, force=False, prune=False, out=None):
+    """
+    :param workers: int
+        Number of worker processes, defaults to the `workers` config value
+    :param force: bool
+        Process all images, not only new or changed ones
+    :param prune: bool
+        Delete the text files of images that were removed
+    :param out: file
+        Stream the progress is printed to, defaults to stdout
+    :return: [] of (str, str, str)
+        Enhances and OCRs the images in INPUT_FOLDER that are new or
+        changed since the last run
+    """
+
+    out = out or sys.stdout
     prepare_folders()
 
     dir_path = os.getcwd()
     config = read_config(config=dir_path + "/config.yml")
+    require_keys(config, "language")
+    set_sink(sink_from_config(config))
+
+    if workers is None:
+        workers = getattr(config, "workers", 0)
 
     images = list(find_images(INPUT_FOLDER))
     print(ORANGE + '~: ' + RESET + 'Found: ' + ORANGE + str(len(images)),
-          RESET + ' images in: ' + ORANGE + INPUT_FOLDER + RESET)
-
-    i = 1
-    for image in images:
-        input_path = os.path.join(
-            INPUT_FOLDER,
-            image
-        )
-        tmp_path = os.path.join(
-            TMP_FOLDER,
-            image
-        )
-
-        out_path = os.path.join(
-            OUTPUT_FOLDER,
-            image + ".txt"
-        )
-
-        if i != 1: print()
+          RESET + ' images in: ' + ORANGE + INPUT_FOLDER + RESET, file=out)
+
+    manifest = manifest_for_config(config, "ocr", OCR_SETTINGS)
+    if manifest is not None:
+        if prune:
+            removed = manifest.prune(images)
+            print(ORANGE + '~: ' + RESET + 'Pruned: ' + ORANGE + str(len(removed)) + RESET + ' removed images',
+                  file=out)
+
+        if not force:
+            found = len(images)
+            images = manifest.pending(images, INPUT_FOLDER)
+            print(ORANGE + '~: ' + RESET + 'Unchanged: ' + ORANGE + str(found - len(images)) +
+                  RESET + ' images, skipped', file=out)
+
+    plans = {}
+    cache = cache_for_config(config)
+    results = ocr_images(images, config.language, workers, engine_for_config(config), cache,
+                         getattr(config, "adaptive_enhancement", False), plans,
+                         getattr(config, "grayscale_first", False), getattr(config, "orientation", True),
+                         getattr(config, "pdf_dpi", PDF_DPI), getattr(config, "crop_to_document", False))
+
+    failed = 0
+    for i, (image, out_path, error) in enumerate(results, 1):
         print(ORANGE + '~: ' + RESET + 'Process image (' + ORANGE + str(i) + '/' + str(
-            len(images)) + RESET + ') : ' + input_path + RESET)
+            len(results)) + RESET + ') : ' + image + RESET, file=out)
 
-        img = cv2.imread(input_path)
-        img = enhance_image(img, tmp_path)
-        cv2.imwrite(tmp_path, img)
+        if error:
+            failed += 1
+            print(ORANGE + '\t~: ' + RESET + 'Failed: ' + error + RESET, file=out)
+        else:
+            if image in plans:
+                plan = plans[image]
+                if isinstance(plan, list):
+                    plan = "; ".join("page %d: %s" % (page, page_plan) for page, page_plan in enumerate(plan, 1))
+                print(ORANGE + '\t~: ' + RESET + 'Enhanced: ' + str(plan) + RESET, file=out)
+            print(ORANGE + '\t~: ' + RESET + 'Result stored at: ' + out_path + RESET, file=out)
+            if manifest is not None:
+                manifest.record(image, os.path.join(INPUT_FOLDER, image), [out_path])
+
+    if manifest is not None:
+        manifest.save()
+
+    print(ORANGE + '~: ' + RESET + 'Processed: ' + ORANGE + str(len(results) - failed) +
+          RESET + ', failed: ' + ORANGE + str(failed) + RESET, file=out)
 
-        run_tesseract(tmp_path, out_path, config.language)
+    if cache is not None:
+        stats = cache.stats()
+        print(ORANGE + '~: ' + RESET + 'OCR cache hits: ' + ORANGE + str(stats["hits"]) +
+              RESET + ', misses: ' + ORANGE + str(stats["misses"]) + RESET, file=out)
 
-        i = i + 1
+    return results
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Enhance and OCR receipt images")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (0 = one per CPU core)")
+    parser.add_argument("--force", action="store_true", help="process all images, not only new or changed ones")
+    parser.add_argument("--prune", action="store_true", help="delete the text files of removed images")
+    args = parser.parse_args()
+
+    main(workers=args.workers, force=args.force, prune=args.prune)
@@ -0,0 +1,344 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Columnar export of parsed receipts. Every export folder has two tables:
+
+    receipts  id, path, market, date, sum
+    items     receipt_id, article, amount
+
+They are written as Parquet if pyarrow is installed, as NumPy .npz files
+otherwise. Sums and amounts are floats, missing values are NaN.
+"""
+import glob
+import os
+
+import numpy as np
+
+from receipt_parser_core.receipt import ReceiptBatch
+from receipt_parser_core.util import convert_to_float
+
+FORMATS = ("parquet", "npz")
+TABLES = ("receipts", "items")
+
+# Receipts written at once, each chunk is a row group or a .npz part
+CHUNK_SIZE = 10000
+
+
+def default_format():
+    """
+    :return: str
+        parquet if pyarrow is installed, npz otherwise
+    """
+
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "npz"
+
+    return "parquet"
+
+
+def batch_columns(batch, paths, first_id=0):
+    """
+    :param batch: ReceiptBatch
+        Parsed receipts
+    :param paths: [] of str
+        Paths of the receipts in the batch
+    :param first_id: int
+        Id of the first receipt
+    :return: ({}, {})
+        Columns of the receipts and the items tables
+    """
+
+    ids = np.arange(first_id, first_id + len(batch), dtype=np.int64)
+    receipts = {
+        "id": ids,
+        "path": list(paths),
+        "market": list(batch.markets),
+        "date": list(batch.dates),
+        "sum": np.array([convert_to_float(value) for value in batch.sums], dtype=np.float64),
+    }
+    items = {
+        "receipt_id": np.repeat(ids, np.diff(np.asarray(batch.item_offsets, dtype=np.int64))),
+        "article": list(batch.articles),
+        "amount": np.array([convert_to_float(value) for value in batch.item_sums], dtype=np.float64),
+    }
+
+    return receipts, items
+
+
+class ColumnarExport(object):
+    """ Writes receipts and their items into columnar files, chunk by chunk """
+
+    def __init__(self, folder, export_format=None, chunk_size=CHUNK_SIZE, append=False):
+        """
+        :param folder: str
+            Folder to write the tables to
+        :param export_format: str
+            parquet or npz, defaults to default_format()
+        :param chunk_size: int
+            Number of receipts kept in memory before they are written
+        :param append: bool
+            Keep the tables already in folder and add to them, they are
+            replaced otherwise. Rows of the kept tables can be removed
+            with drop.
+        """
+
+        self.folder = folder
+        self.format = export_format or default_format()
+        if self.format not in FORMATS:
+            raise ValueError("Unknown export format: " + self.format)
+        self.chunk_size = chunk_size
+
+        os.makedirs(folder, exist_ok=True)
+        if append:
+            # ids stay unique even after rows were dropped
+            parts = self._parts("receipts")
+            self.next_id = max((self._max_id(path) for path in parts), default=-1) + 1
+            self._part = len(parts)
+        else:
+            for table in TABLES:
+                for path in self._parts(table):
+                    os.remove(path)
+            self.next_id = 0
+            self._part = 0
+
+        self._kept_parts = self._part
+        self._batch = ReceiptBatch()
+        self._paths = []
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.next_id + len(self._batch)
+
+    def _parts(self, table):
+        return sorted(glob.glob(os.path.join(self.folder, "%s-*.%s" % (table, self.format))))
+
+    def _part_path(self, table, part=None):
+        part = self._part if part is None else part
+        return os.path.join(self.folder, "%s-%05d.%s" % (table, part, self.format))
+
+    def _max_id(self, path):
+        if self.format == "parquet":
+            import pyarrow.compute as pc
+            import pyarrow.parquet as pq
+
+            ids = pq.read_table(path, columns=["id"]).column("id")
+            return -1 if not len(ids) else pc.max(ids).as_py()
+
+        with np.load(path) as data:
+            return int(data["id"].max()) if len(data["id"]) else -1
+
+    def drop(self, paths):
+        """
+        :param paths: iterable of str
+            Paths of receipts to remove, with their items
+        :return: int
+            Number of receipts removed. Only the parts that were in the
+            folder when it was opened are rewritten, not the new ones.
+        """
+
+        paths = sorted(set(paths))
+        if not paths:
+            return 0
+
+        dropped = 0
+        for part in range(self._kept_parts):
+            if self.format == "parquet":
+                dropped += self._drop_parquet(part, paths)
+            else:
+                dropped += self._drop_npz(part, paths)
+
+        return dropped
+
+    def _drop_parquet(self, part, paths):
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        import pyarrow.parquet as pq
+
+        receipts_path, items_path = (self._part_path(table, part) for table in TABLES)
+        receipts = pq.read_table(receipts_path)
+        stale = pc.is_in(receipts.column("path"), value_set=pa.array(paths, pa.string()))
+        count = pc.sum(stale).as_py() or 0
+        if not count:
+            return 0
+
+        items = pq.read_table(items_path)
+        stale_ids = receipts.filter(stale).column("id")
+        _replace_parquet(receipts_path, receipts.filter(pc.invert(stale)))
+        _replace_parquet(items_path, items.filter(pc.invert(pc.is_in(items.column("receipt_id"), value_set=stale_ids))))
+
+        return count
+
+    def _drop_npz(self, part, paths):
+        receipts_path, items_path = (self._part_path(table, part) for table in TABLES)
+        with np.load(receipts_path) as data:
+            receipts = dict(data)
+        stale = np.isin(receipts["path"], paths)
+        count = int(np.count_nonzero(stale))
+        if not count:
+            return 0
+
+        with np.load(items_path) as data:
+            items = dict(data)
+        stale_items = np.isin(items["receipt_id"], receipts["id"][stale])
+        _replace_npz(receipts_path, {name: values[~stale] for name, values in receipts.items()})
+        _replace_npz(items_path, {name: values[~stale_items] for name, values in items.items()})
+
+        return count
+
+    def add(self, receipt_path, receipt):
+        """
+        :param receipt_path: str
+            Path of the parsed file
+        :param receipt: Receipt
+            Parsed receipt
+        :return: void
+            Writes a chunk once chunk_size receipts were added
+        """
+
+        self._paths.append(receipt_path)
+        self._batch.append(receipt)
+
+        if len(self._batch) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """
+        :return: void
+            Writes the receipts added since the last flush
+        """
+
+        if not len(self._batch):
+            return
+
+        tables = dict(zip(TABLES, batch_columns(self._batch, self._paths, self.next_id)))
+        if self.format == "parquet":
+            self._write_parquet(tables)
+        else:
+            self._write_npz(tables)
+
+        self.next_id += len(self._batch)
+        self._batch = ReceiptBatch()
+        self._paths = []
+
+    def _write_parquet(self, tables):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        for table, columns in tables.items():
+            schema = _parquet_schema(table)
+            data = pa.Table.from_arrays([
+                # NaN sums become nulls
+                pa.array(columns[field.name], type=field.type, from_pandas=True) for field in schema
+            ], schema=schema)
+
+            writer = self._writers.get(table)
+            if writer is None:
+                writer = pq.ParquetWriter(self._part_path(table), data.schema)
+                self._writers[table] = writer
+            writer.write_table(data)
+
+    def _write_npz(self, tables):
+        # one part per chunk, .npz files can not be appended to
+        for table, columns in tables.items():
+            np.savez(self._part_path(table), **{
+                name: np.array(["" if value is None else value for value in values], dtype=str)
+                if isinstance(values, list) else values
+                for name, values in columns.items()
+            })
+        self._part += 1
+
+    def close(self):
+        """
+        :return: void
+            Writes the remaining receipts and closes the files
+        """
+
+        self.flush()
+
+        for writer in self._writers.values():
+            writer.close()
+        if self._writers:
+            self._part += 1
+        self._writers = {}
+
+
+def _replace_parquet(path, data):
+    import pyarrow.parquet as pq
+
+    tmp_path = path + ".tmp"
+    pq.write_table(data, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _replace_npz(path, columns):
+    # written through a stream, np.savez would add .npz to the temporary name
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as stream:
+        np.savez(stream, **columns)
+    os.replace(tmp_path, path)
+
+
+def _parquet_schema(table):
+    import pyarrow as pa
+
+    if table == "receipts":
+        return pa.schema([
+            ("id", pa.int64()), ("path", pa.string()), ("market", pa.string()),
+            ("date", pa.string()), ("sum", pa.float64()),
+        ])
+
+    return pa.schema([("receipt_id", pa.int64()), ("article", pa.string()), ("amount", pa.float64())])
+
+
+def read_table(folder, table, export_format=None):
+    """
+    :param folder: str
+        Folder the tables were exported to
+    :param table: str
+        receipts or items
+    :param export_format: str
+        parquet or npz, defaults to default_format()
+    :return: {} of str to numpy.ndarray
+        Columns of all parts of the table
+    """
+
+    export_format = export_format or default_format()
+    paths = sorted(glob.glob(os.path.join(folder, "%s-*.%s" % (table, export_format))))
+
+    if export_format == "parquet":
+        import pyarrow.parquet as pq
+
+        columns = _parquet_schema(table).names
+        parts = [pq.read_table(path) for path in paths]
+        return {
+            name: np.concatenate([part.column(name).to_numpy() for part in parts])
+            if parts else np.array([]) for name in columns
+        }
+
+    parts = [dict(np.load(path)) for path in paths]
+    if not parts:
+        return {}
+
+    return {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
@@ -0,0 +1,213 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Fast extraction of single fields. Only the text lines the fields are
+usually found on are OCRed: the header for the market and the date, the
+lines above the bottom for the total.
+"""
+import cv2
+import numpy as np
+
+from receipt_parser_core.config import require_keys
+from receipt_parser_core.enhancer import enhance_image, ocr_image, process_image, process_image_bytes, process_pages
+from receipt_parser_core.metrics import instrumented
+from receipt_parser_core.ocr import engine_for_config
+from receipt_parser_core.pages import PDF_DPI, document_type, iter_pages
+from receipt_parser_core.receipt import Receipt
+
+# Fields extract_fields can find without OCRing the whole receipt
+FIELDS = ("market", "date", "sum")
+
+# Fields found in the header, the rest are searched from the bottom up
+HEADER_FIELDS = ("market", "date")
+
+
+def text_bands(img, max_size=1000, min_ink=0.01):
+    """
+    :param img: numpy.ndarray
+        Enhanced image, dark text on a light background
+    :param max_size: int
+        Images are narrowed to this width to count the ink, the rows
+        keep their full resolution
+    :param min_ink: float
+        Share of dark pixels a row needs to be part of a text line
+    :return: [] of (int, int)
+        First and last row + 1 of every text line, top to bottom
+    """
+
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    if width > max_size:
+        gray = cv2.resize(gray, (max_size, height), interpolation=cv2.INTER_AREA)
+
+    _, ink = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    rows = np.count_nonzero(ink, axis=1) > min_ink * ink.shape[1]
+
+    # runs of text rows, as (start, end) pairs
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], rows.view(np.int8), [0]))))
+    runs = edges.reshape(-1, 2)
+    if not len(runs):
+        return []
+
+    # umlauts and accents are separated from their line by a few rows
+    line_height = int(np.median(runs[:, 1] - runs[:, 0]))
+    gap = max(1, line_height // 4)
+
+    bands = [list(runs[0])]
+    for start, end in runs[1:]:
+        if start - bands[-1][1] <= gap:
+            bands[-1][1] = end
+        else:
+            bands.append([start, end])
+
+    return [
+        (max(0, int(start) - gap), min(height, int(end) + gap))
+        for start, end in bands if end - start > gap
+    ]
+
+
+def _ocr_bands(config, img, bands, engine):
+    # one block per request keeps tesseract's layout analysis simple
+    text = ocr_image(img[bands[0][0]:bands[-1][1]], config.language, engine, psm=6)
+    return text.splitlines(keepends=True)
+
+
+def _missing(fields, found):
+    return [field for field in fields if found.get(field) is None]
+
+
+@instrumented("extract_fields", shape=lambda config, img, *args, **kwargs: img.shape)
+def extract_fields(config, img, fields=FIELDS, engine=None, header_lines=6, window_lines=8, max_windows=3):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param img: numpy.ndarray
+        Image of the receipt, as returned by cv2.imread
+    :param fields: iterable of str
+        Fields the caller needs, any of FIELDS. Asking for items parses
+        the whole receipt, see process_image.
+    :param engine: OcrEngine
+        Engine to run tesseract on, defaults to the one for config
+    :param header_lines: int
+        Text lines at the top the market and the date are looked for in
+    :param window_lines: int
+        Text lines OCRed at once while searching the total from the bottom up
+    :param max_windows: int
+        Windows searched for the total before the whole receipt is OCRed
+    :return: Receipt
+        Receipt with the requested fields. Its lines are the OCRed ones
+        and it has no items, unless the whole receipt had to be OCRed.
+    """
+
+    fields = tuple(fields)
+    unknown = set(fields) - set(FIELDS + ("items",))
+    if unknown:
+        raise ValueError("Unknown fields: " + ", ".join(sorted(unknown)))
+    if "items" in fields:
+        return process_image(config, img)[1]
+
+    require_keys(config, "language")
+    if engine is None:
+        engine = engine_for_config(config)
+
+    rotate = getattr(config, "orientation", True)
+    img = enhance_image(
+        img, None, rotate=rotate, adaptive=getattr(config, "adaptive_enhancement", False),
+        grayscale_first=getattr(config, "grayscale_first", False), crop=getattr(config, "crop_to_document", False)
+    )
+
+    bands = text_bands(img)
+    found = {}
+    header, footer = [], []
+
+    if bands:
+        head = []
+        if any(field in fields for field in HEADER_FIELDS):
+            head = bands[:header_lines]
+            header = _ocr_bands(config, img, head, engine)
+            receipt = Receipt(config, header, keep_lines=False)
+            found.update(market=receipt.market, date=receipt.date)
+
+        # the total is printed below the items, followed by payment and tax lines
+        end = len(bands)
+        for _ in range(max_windows):
+            if not _missing(fields, found) or end <= len(head):
+                break
+
+            start = max(len(head), end - window_lines)
+            footer = _ocr_bands(config, img, bands[start:end], engine) + footer
+            end = start
+
+            receipt = Receipt(config, footer, keep_lines=False)
+            for field in _missing(fields, found):
+                found[field] = getattr(receipt, field)
+
+        if not _missing(fields, found):
+            receipt = Receipt(config, header + footer)
+            receipt.market, receipt.date, receipt.sum = (found.get(field) for field in FIELDS)
+            receipt.items = None
+            return receipt
+
+    raw = ocr_image(img, config.language, engine)
+    return Receipt(config, raw.splitlines(keepends=True))
+
+
+def extract_image_bytes(config, data, fields=FIELDS):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param data: bytes
+        Encoded image, in any format OpenCV can read, or a PDF or TIFF
+    :param fields: iterable of str
+        Fields the caller needs, see extract_fields
+    :return: Receipt
+        Receipt with the requested fields. Documents with several pages
+        are OCRed completely, see process_image_bytes.
+    """
+
+    if document_type(data):
+        return process_image_bytes(config, data)
+
+    img = None
+    if data:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("Could not decode image")
+
+    return extract_fields(config, img, fields)
+
+
+def extract_receipt(config, path, fields=FIELDS):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param path: str
+        Image, PDF or TIFF of the receipt
+    :param fields: iterable of str
+        Fields the caller needs, see extract_fields
+    :return: Receipt
+        Receipt with the requested fields
+    """
+
+    if document_type(path):
+        return process_pages(config, iter_pages(path, getattr(config, "pdf_dpi", PDF_DPI)))[1]
+
+    img = cv2.imread(path)
+    if img is None:
+        raise ValueError("Could not read image: " + path)
+
+    return extract_fields(config, img, fields)
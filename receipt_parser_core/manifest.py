@@ -0,0 +1,244 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import os
+from collections.abc import Mapping
+
+
+def file_hash(path):
+    """
+    :param path: str
+        File to hash
+    :return: str
+        SHA-256 of the file contents
+    """
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def config_fingerprint(config, keys=None):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param keys: iterable of str
+        Config values the outputs depend on, None for all of them
+    :return: str
+        Hash of these config values
+    """
+
+    values = vars(config)
+    if keys is not None:
+        values = {key: values.get(key) for key in keys}
+
+    data = json.dumps(values, sort_keys=True, default=_jsonable)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _jsonable(value):
+    return dict(value) if isinstance(value, Mapping) else str(value)
+
+
+class Manifest(object):
+    """ Remembers which inputs a stage already processed, and with which config """
+
+    def __init__(self, path, fingerprint):
+        """
+        :param path: str
+            JSON file to keep the manifest in
+        :param fingerprint: str
+            Fingerprint of the config the outputs are created with
+        """
+
+        self.path = path
+        self.fingerprint = fingerprint
+        self._entries = {}
+        self._dirty = False
+
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as stream:
+                self._entries = json.load(stream)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def is_current(self, name, input_path):
+        """
+        :param name: str
+            Name of the input in the manifest
+        :param input_path: str
+            Path of the input
+        :return: bool
+            True iff input_path was processed with the current config
+            and neither it nor its outputs changed since. The file is
+            only hashed if its mtime changed but its size did not.
+        """
+
+        entry = self._entries.get(name)
+        if entry is None or entry["config"] != self.fingerprint:
+            return False
+
+        if not all(os.path.exists(output) for output in entry["outputs"]):
+            return False
+
+        try:
+            stat = os.stat(input_path)
+        except OSError:
+            return False
+
+        if stat.st_size != entry["size"]:
+            return False
+        if stat.st_mtime_ns == entry["mtime"]:
+            return True
+
+        # touched, but maybe not changed
+        if file_hash(input_path) != entry["sha256"]:
+            return False
+
+        entry["mtime"] = stat.st_mtime_ns
+        self._dirty = True
+        return True
+
+    def pending(self, names, folder=""):
+        """
+        :param names: iterable of str
+            Names of the inputs
+        :param folder: str
+            Folder the inputs are in
+        :return: [] of str
+            Names of the inputs that are new or changed
+        """
+
+        return list(self.iter_pending(names, folder))
+
+    def iter_pending(self, names, folder=""):
+        """
+        :param names: iterable of str
+            Names of the inputs, only read as far as the result is
+        :param folder: str
+            Folder the inputs are in
+        :return: generator of str
+            Names of the inputs that are new or changed
+        """
+
+        for name in names:
+            if not self.is_current(name, os.path.join(folder, name)):
+                yield name
+
+    def record(self, name, input_path, outputs=()):
+        """
+        :param name: str
+            Name of the input in the manifest
+        :param input_path: str
+            Path of the input
+        :param outputs: iterable of str
+            Files created from the input
+        :return: void
+        """
+
+        stat = os.stat(input_path)
+        self._entries[name] = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": file_hash(input_path),
+            "config": self.fingerprint,
+            "outputs": list(outputs),
+        }
+        self._dirty = True
+
+    def prune(self, names):
+        """
+        :param names: iterable of str
+            Names of all inputs that still exist
+        :return: [] of str
+            Names of the removed inputs, their outputs are deleted
+        """
+
+        return self._remove(sorted(set(self._entries) - set(names)))
+
+    def prune_missing(self, folder=""):
+        """
+        :param folder: str
+            Folder the inputs are in
+        :return: [] of str
+            Names of the inputs that no longer exist, their outputs are
+            deleted. Unlike prune, the inputs need not be listed.
+        """
+
+        return self._remove(sorted(
+            name for name in self._entries if not os.path.exists(os.path.join(folder, name))
+        ))
+
+    def _remove(self, removed):
+        for name in removed:
+            for output in self._entries.pop(name)["outputs"]:
+                try:
+                    os.remove(output)
+                except FileNotFoundError:
+                    pass
+
+        if removed:
+            self._dirty = True
+
+        return removed
+
+    def save(self):
+        """
+        :return: void
+            Writes the manifest if it changed
+        """
+
+        if not self._dirty:
+            return
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as stream:
+            json.dump(self._entries, stream)
+        os.replace(tmp_path, self.path)
+
+        self._dirty = False
+
+
+def manifest_for_config(config, stage, keys=None):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param stage: str
+        Name of the stage, every stage has its own manifest
+    :param keys: iterable of str
+        Config values the outputs of the stage depend on, None for all
+    :return: Manifest
+        Manifest in manifest_path, None if incremental runs are disabled
+    """
+
+    path = getattr(config, "manifest_path", None)
+    if not path:
+        return None
+
+    return Manifest(os.path.join(path, stage + ".json"), config_fingerprint(config, keys))
@@ -0,0 +1,197 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from array import array
+from difflib import SequenceMatcher
+
+# Accuracy levels tried by Receipt.parse_market, best first
+MARKET_ACCURACIES = (1.0, 0.9, 0.8, 0.7)
+
+
+def _ratio_bound(length, other_length):
+    """ Upper bound of SequenceMatcher.ratio() for strings of these lengths """
+    return 2.0 * min(length, other_length) / (length + other_length)
+
+
+class TokenizedLines(object):
+    """ Words of the receipt lines, split once and shared by all parse stages """
+
+    __slots__ = ("words", "offsets", "first_line", "_by_length")
+
+    def __init__(self, lines):
+        """
+        :param lines: [] of str
+            Normalized receipt lines
+        """
+
+        words = []
+        offsets = array("l", [0])
+        first_line = {}
+
+        for index, line in enumerate(lines):
+            for word in line.split():
+                words.append(word)
+                if word not in first_line:
+                    first_line[word] = index
+            offsets.append(len(words))
+
+        self.words = tuple(words)
+        self.offsets = offsets
+        self.first_line = first_line
+        self._by_length = None
+
+    def line_words(self, index):
+        """
+        :param index: int
+            Line number
+        :return: () of str
+            Words of the line
+        """
+
+        return self.words[self.offsets[index]:self.offsets[index + 1]]
+
+    @property
+    def by_length(self):
+        """
+        :return: {}
+            Distinct words by their length
+        """
+
+        if self._by_length is None:
+            by_length = {}
+            for word in self.first_line:
+                by_length.setdefault(len(word), []).append(word)
+            self._by_length = by_length
+
+        return self._by_length
+
+    def find(self, keyword, accuracy=0.6):
+        """
+        :param keyword: str
+            The keyword string to look for
+        :param accuracy: float
+            Required accuracy for a match of a word with the keyword
+        :return: int
+            Number of the first line with a word that
+            difflib.get_close_matches(keyword, words, 1, accuracy) would
+            return, None if there is none
+        """
+
+        if accuracy >= 1.0:
+            return self.first_line.get(keyword)
+
+        matcher = SequenceMatcher(None, "", keyword)
+        keyword_length = len(keyword)
+
+        match_line = None
+        for length, words in self.by_length.items():
+            if _ratio_bound(length, keyword_length) < accuracy:
+                continue
+
+            for word in words:
+                line = self.first_line[word]
+                if match_line is not None and line >= match_line:
+                    continue
+
+                matcher.set_seq1(word)
+                if matcher.quick_ratio() >= accuracy and matcher.ratio() >= accuracy:
+                    match_line = line
+
+        return match_line
+
+
+class MarketMatcher(object):
+    """ Finds the market of a receipt, built once per config """
+
+    def __init__(self, markets, accuracies=MARKET_ACCURACIES):
+        """
+        :param markets: {}
+            Market names and their spellings, as in the config file
+        :param accuracies: () of float
+            Accuracy levels to try, best first
+        """
+
+        self.accuracies = accuracies
+        self.spellings = [
+            (market, spelling) for market, spellings in markets.items() for spelling in spellings
+        ]
+
+        # first spelling of every distinct string
+        self._exact = {}
+        for index, (_, spelling) in enumerate(self.spellings):
+            self._exact.setdefault(spelling, index)
+
+    def match(self, tokens):
+        """
+        :param tokens: TokenizedLines
+            Words of the normalized receipt lines
+        :return: str
+            The market parse_market finds: the first market with a
+            spelling that matches any word at the best accuracy level
+        """
+
+        # a ratio of 1.0 is only possible for equal strings
+        exact = [self._exact[word] for word in tokens.first_line if word in self._exact]
+        if exact and self.accuracies[0] >= 1.0:
+            return self.spellings[min(exact)][0]
+
+        fuzzy_accuracies = [accuracy for accuracy in self.accuracies if accuracy < 1.0]
+        if not fuzzy_accuracies:
+            return None
+
+        # Spellings are visited in config order, so a later spelling only
+        # wins if it reaches a strictly better accuracy level
+        market_match, match_level = None, len(fuzzy_accuracies)
+        for market, spelling in self.spellings:
+            if match_level == 0:
+                break
+
+            cutoff = fuzzy_accuracies[match_level - 1]
+            level = self._best_level(spelling, tokens.by_length, fuzzy_accuracies, cutoff)
+            if level is not None and level < match_level:
+                market_match, match_level = market, level
+
+        return market_match
+
+    def _best_level(self, spelling, words_by_length, accuracies, cutoff):
+        """
+        Index of the best accuracy level at which spelling matches any of
+        the words, with the ratio difflib.get_close_matches would compute.
+        """
+
+        matcher = SequenceMatcher(None, "", spelling)
+        spelling_length = len(spelling)
+
+        best = 0.0
+        for length, words in words_by_length.items():
+            if _ratio_bound(length, spelling_length) < max(cutoff, best):
+                continue
+
+            for word in words:
+                matcher.set_seq1(word)
+                quick_ratio = matcher.quick_ratio()
+                if quick_ratio >= cutoff and quick_ratio > best:
+                    best = max(best, matcher.ratio())
+
+            if best >= accuracies[0]:
+                break
+
+        for level, accuracy in enumerate(accuracies):
+            if best >= accuracy:
+                return level
+
+        return None
+
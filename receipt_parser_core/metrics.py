@@ -0,0 +1,300 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict, namedtuple
+
+StageEvent = namedtuple("StageEvent", ("stage", "duration", "shape", "outcome"))
+
+# Upper bounds of the duration histogram buckets in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class NullSink(object):
+    """ Drops all events, instrumented stages skip timing entirely """
+
+    enabled = False
+
+    def emit(self, event):
+        pass
+
+
+class LoggingSink(object):
+    """ Writes every event to a logger """
+
+    enabled = True
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        :param logger: logging.Logger
+            Logger to write to
+        :param level: int
+            Log level of the events
+        """
+
+        self.logger = logger or logging.getLogger("receipt_parser_core.metrics")
+        self.level = level
+
+    def emit(self, event):
+        self.logger.log(
+            self.level, "stage=%s duration=%.6f shape=%s outcome=%s",
+            event.stage, event.duration, event.shape, event.outcome
+        )
+
+
+class PrometheusSink(object):
+    """ Aggregates events into histograms in the Prometheus text format """
+
+    enabled = True
+
+    def __init__(self, prefix="receipt_parser", metric="stage_seconds", label="stage",
+                 description="Duration of the receipt pipeline stages"):
+        """
+        :param prefix: str
+            Prefix of the metric names
+        :param metric: str
+            Name of the histogram
+        :param label: str
+            Label the stage names are reported as
+        :param description: str
+            Help text of the histogram
+        """
+
+        self.prefix = prefix
+        self.metric = metric
+        self.label = label
+        self.description = description
+        self._buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self._sums = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def emit(self, event):
+        key = (event.stage, event.outcome)
+        with self._lock:
+            buckets = self._buckets[key]
+            for i, bound in enumerate(BUCKETS):
+                if event.duration <= bound:
+                    buckets[i] += 1
+            self._sums[key] += event.duration
+            self._counts[key] += 1
+
+    def render(self):
+        """
+        :return: str
+            All metrics in the Prometheus text exposition format
+        """
+
+        name = self.prefix + "_" + self.metric
+        lines = [
+            "# HELP " + name + " " + self.description,
+            "# TYPE " + name + " histogram",
+        ]
+
+        with self._lock:
+            for (stage, outcome), buckets in sorted(self._buckets.items()):
+                labels = '%s="%s",outcome="%s"' % (self.label, stage, outcome)
+                for bound, count in zip(BUCKETS, buckets):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, self._counts[(stage, outcome)]))
+                lines.append("%s_sum{%s} %f" % (name, labels, self._sums[(stage, outcome)]))
+                lines.append("%s_count{%s} %d" % (name, labels, self._counts[(stage, outcome)]))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """
+        :param port: int
+            Port to listen on
+        :param host: str
+            Address to listen on
+        :return: ThreadingHTTPServer
+            Serves render() at /metrics from a background thread
+        """
+
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+
+class StatsdSink(object):
+    """ Sends every event as a StatsD timer over UDP """
+
+    enabled = True
+
+    def __init__(self, host="127.0.0.1", port=8125, prefix="receipt_parser"):
+        """
+        :param host: str
+            StatsD host
+        :param port: int
+            StatsD port
+        :param prefix: str
+            Prefix of the metric names
+        """
+
+        import socket
+
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def emit(self, event):
+        packet = "%s.%s.%s:%f|ms" % (self.prefix, event.stage, event.outcome, event.duration * 1000)
+        try:
+            self._socket.sendto(packet.encode("utf-8"), self.address)
+        except OSError:
+            pass
+
+
+NULL_SINK = NullSink()
+_sink = NULL_SINK
+
+# Prometheus sinks served by sink_from_config, by port
+_served = {}
+_served_lock = threading.Lock()
+
+
+def get_sink():
+    """
+    :return: sink
+        Sink that currently receives the events
+    """
+
+    return _sink
+
+
+def set_sink(sink):
+    """
+    :param sink: sink
+        Object with an `enabled` flag and an `emit(event)` method,
+        None to disable instrumentation again
+    :return: void
+    """
+
+    global _sink
+    _sink = sink or NULL_SINK
+
+
+def sink_from_config(config):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :return: sink
+        Sink selected by the `metrics` config value: none, logging,
+        prometheus or statsd. A prometheus sink is served once per
+        process and port, later calls return the same sink.
+    """
+
+    kind = getattr(config, "metrics", None) or "none"
+    if kind == "none":
+        return NULL_SINK
+    if kind == "logging":
+        return LoggingSink()
+    if kind == "prometheus":
+        port = getattr(config, "metrics_port", 9100)
+        with _served_lock:
+            sink = _served.get(port)
+            if sink is None:
+                sink = PrometheusSink()
+                sink.serve(port)
+                _served[port] = sink
+        return sink
+    if kind == "statsd":
+        host, _, port = getattr(config, "metrics_address", "127.0.0.1:8125").partition(":")
+        return StatsdSink(host, int(port or 8125))
+
+    raise ValueError("Unknown metrics sink: " + kind)
+
+
+def emit(stage, duration, shape=None, outcome="ok"):
+    """
+    :param stage: str
+        Name of the stage
+    :param duration: float
+        Duration in seconds
+    :param shape: tuple
+        Dimensions of the stage input
+    :param outcome: str
+        ok, error or anything more specific
+    :return: void
+        Sends an event to the current sink
+    """
+
+    if _sink.enabled:
+        _sink.emit(StageEvent(stage, duration, shape, outcome))
+
+
+def _input_shape(args):
+    for arg in args:
+        shape = getattr(arg, "shape", None)
+        if shape is not None:
+            return tuple(shape)
+    return None
+
+
+def instrumented(stage, shape=None):
+    """
+    :param stage: str
+        Name of the stage
+    :param shape: callable
+        Returns the dimensions of the input from the call arguments,
+        defaults to the shape of the first array argument
+    :return: decorator
+        Emits a StageEvent for every call of the decorated function
+    """
+
+    shape = shape or (lambda *args, **kwargs: _input_shape(args))
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if not sink.enabled:
+                return function(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                sink.emit(StageEvent(stage, time.perf_counter() - start, shape(*args, **kwargs), "error"))
+                raise
+
+            sink.emit(StageEvent(stage, time.perf_counter() - start, shape(*args, **kwargs), "ok"))
+            return result
+
+        return wrapper
+
+    return decorator
@@ -42,5 +42,8 @@ class ObjectView(object):
         :param market: str
             Object value
         """
+        if not market:
+            return self.__dict__[key]
+
         custom_config_key = f"{key}_{market.lower()}"
         return self.__dict__.get(custom_config_key, self.__dict__[key])
@@ -0,0 +1,318 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import functools
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from pytesseract import pytesseract
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+from receipt_parser_core.config import require_keys
+
+logger = logging.getLogger(__name__)
+
+# Tesseract instance of the current worker process, see _init_worker
+_worker = None
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def limit_memory(memory_limit):
+    """
+    :param memory_limit: int
+        Address space limit in MB, 0 or None for no limit
+    :return: void
+        Limits the memory of the current process and its children
+    """
+
+    if memory_limit and resource is not None:
+        limit = int(memory_limit) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+class Tesseract(object):
+    """ A single tesseract instance with its language model loaded once """
+
+    def __init__(self, language="deu", timeout=60):
+        """
+        :param language: str
+            Tesseract language
+        :param timeout: int
+            Seconds to wait for the text of a single image, 0 for no limit
+        """
+
+        self.language = language
+        self.timeout = timeout
+        self.api = None
+
+        if tesserocr is not None:
+            self.api = tesserocr.PyTessBaseAPI(lang=language)
+        else:
+            _warn_without_tesserocr()
+
+    def recognize(self, img, psm=6):
+        """
+        :param img: numpy.ndarray | PIL.Image.Image
+            Image to OCR, numpy arrays are expected in RGB channel order
+        :param psm: int
+            Tesseract page segmentation mode
+        :return: str
+            Text found in image
+        """
+
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+
+        if self.api is None:
+            return pytesseract.image_to_string(
+                img, lang=self.language, timeout=self.timeout, config="--psm " + str(psm)
+            )
+
+        self.api.SetPageSegMode(psm)
+        self.api.SetImage(img)
+        if not self.api.Recognize(int(self.timeout * 1000)):
+            raise RuntimeError("Tesseract process timeout")
+        return self.api.GetUTF8Text()
+
+    def orientation(self, img):
+        """
+        :param img: numpy.ndarray | PIL.Image.Image
+            Image to detect the orientation of
+        :return: (int, float)
+            Clockwise rotation in degrees that makes the text upright and
+            the confidence of tesseract's orientation and script detection
+        """
+
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
+
+        if self.api is None:
+            osd = pytesseract.image_to_osd(img, timeout=self.timeout, output_type=pytesseract.Output.DICT)
+            return int(osd["rotate"]), float(osd["orientation_conf"])
+
+        self.api.SetPageSegMode(tesserocr.PSM.OSD_ONLY)
+        self.api.SetImage(img)
+        osd = self.api.DetectOrientationScript()
+        if not osd:
+            raise RuntimeError("Orientation detection failed")
+
+        # tesseract reports the counter clockwise orientation of the page
+        return (360 - osd["orient_deg"]) % 360, float(osd["orient_conf"])
+
+
+@functools.lru_cache(maxsize=None)
+def _warn_without_tesserocr():
+    logger.warning(
+        "tesserocr is not installed, every image starts a new tesseract process "
+        "that loads the language model again"
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def tesseract_version():
+    """
+    :return: str
+        Version of the tesseract library or binary used for OCR
+    """
+
+    if tesserocr is not None:
+        return tesserocr.tesseract_version()
+
+    return str(pytesseract.get_tesseract_version())
+
+
+def _init_worker(language, memory_limit, timeout):
+    global _worker
+
+    limit_memory(memory_limit)
+    _worker = Tesseract(language, timeout)
+
+
+def _ready():
+    return _worker is not None
+
+
+def _recognize(img, psm):
+    return _worker.recognize(img, psm)
+
+
+def _orientation(img):
+    return _worker.orientation(img)
+
+
+class OcrEngine(object):
+    """ Pool of warm tesseract instances that many threads can dispatch to """
+
+    def __init__(self, language="deu", pool_size=0, memory_limit=0, timeout=60):
+        """
+        :param language: str
+            Tesseract language
+        :param pool_size: int
+            Number of persistent tesseract worker processes. 0 keeps one
+            tesseract instance per calling thread in the current process.
+        :param memory_limit: int
+            Address space limit per worker process in MB, 0 for no limit.
+            Not applied if pool_size is 0.
+        :param timeout: int
+            Seconds to wait for a single image, 0 for no limit
+        """
+
+        self.language = language
+        self.pool_size = pool_size
+        self.memory_limit = memory_limit
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.pool_size,
+                    initializer=_init_worker,
+                    initargs=(self.language, self.memory_limit, self.timeout),
+                )
+            return self._executor
+
+    def _get_local(self):
+        tesseract = getattr(self._local, "tesseract", None)
+        if tesseract is None:
+            tesseract = Tesseract(self.language, self.timeout)
+            self._local.tesseract = tesseract
+        return tesseract
+
+    def warm_up(self):
+        """
+        :return: void
+            Starts the tesseract instance of the calling thread, or the
+            worker processes of the pool, before the first image comes in
+        """
+
+        if not self.pool_size:
+            self._get_local()
+            return
+
+        executor = self._get_executor()
+        for future in [executor.submit(_ready) for _ in range(self.pool_size)]:
+            future.result(self.timeout or None)
+
+    def image_to_string(self, img, psm=6):
+        """
+        :param img: numpy.ndarray | PIL.Image.Image
+            Image to OCR, numpy arrays are expected in RGB channel order
+        :param psm: int
+            Tesseract page segmentation mode
+        :return: str
+            Text found in image
+        """
+
+        if not self.pool_size:
+            return self._get_local().recognize(img, psm)
+
+        future = self._get_executor().submit(_recognize, img, psm)
+        return future.result(self.timeout or None)
+
+    def orientation(self, img):
+        """
+        :param img: numpy.ndarray | PIL.Image.Image
+            Image to detect the orientation of
+        :return: (int, float)
+            Clockwise rotation in degrees that makes the text upright and
+            its confidence, see Tesseract.orientation
+        """
+
+        if not self.pool_size:
+            return self._get_local().orientation(img)
+
+        future = self._get_executor().submit(_orientation, img)
+        return future.result(self.timeout or None)
+
+    def __reduce__(self):
+        # worker processes use their own process-wide engine with the same settings
+        return get_engine, (self.language, self.pool_size, self.memory_limit, self.timeout)
+
+    def close(self):
+        """
+        :return: void
+            Stops the worker processes
+        """
+
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def get_engine(language="deu", pool_size=0, memory_limit=0, timeout=60):
+    """
+    :param language: str
+        Tesseract language
+    :param pool_size: int
+        Number of persistent tesseract worker processes
+    :param memory_limit: int
+        Address space limit per worker process in MB
+    :param timeout: int
+        Seconds to wait for a single image, 0 for no limit
+    :return: OcrEngine
+        Process-wide engine for these settings, created on first use
+    """
+
+    key = (language, pool_size, memory_limit, timeout)
+    with _engines_lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = OcrEngine(language, pool_size, memory_limit, timeout)
+            _engines[key] = engine
+        return engine
+
+
+def engine_for_config(config):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :return: OcrEngine
+        Process-wide engine for the OCR settings in config
+    """
+
+    require_keys(config, "language")
+    return get_engine(
+        config.language,
+        getattr(config, "ocr_pool_size", 0),
+        getattr(config, "ocr_memory_limit", 0),
+        getattr(config, "ocr_timeout", 60),
+    )
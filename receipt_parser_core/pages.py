@@ -0,0 +1,133 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Pages of multi-page documents. PDFs are rasterized with pypdfium2
+(`poetry install -E pdf`), TIFFs are read frame by frame with Pillow.
+"""
+import io
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Resolution PDF pages are rasterized at
+PDF_DPI = 300
+
+_PDF_MAGIC = b"%PDF"
+_TIFF_MAGIC = (b"II*\x00", b"MM\x00*")
+
+
+def _header(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source[:4])
+
+    with open(source, "rb") as stream:
+        return stream.read(4)
+
+
+def document_type(source):
+    """
+    :param source: str | bytes
+        Path or contents of a file
+    :return: str
+        pdf or tiff for documents that may have several pages, None for
+        everything else
+    """
+
+    try:
+        header = _header(source)
+    except OSError:
+        return None
+
+    if header == _PDF_MAGIC:
+        return "pdf"
+    if header in _TIFF_MAGIC:
+        return "tiff"
+    return None
+
+
+def _pdf_pages(source, dpi):
+    try:
+        import pypdfium2
+    except ImportError:
+        raise ValueError("Reading PDFs needs pypdfium2, install it with `poetry install -E pdf`") from None
+
+    pdf = pypdfium2.PdfDocument(bytes(source) if isinstance(source, (bytearray, memoryview)) else source)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            bitmap = page.render(scale=dpi / 72)
+            try:
+                # pdfium renders BGR, the buffer is freed with the bitmap
+                img = np.array(bitmap.to_numpy())
+            finally:
+                bitmap.close()
+                page.close()
+
+            yield img
+    finally:
+        pdf.close()
+
+
+def _tiff_pages(source):
+    stream = io.BytesIO(source) if isinstance(source, (bytes, bytearray, memoryview)) else source
+    with Image.open(stream) as image:
+        for index in range(getattr(image, "n_frames", 1)):
+            image.seek(index)
+            yield cv2.cvtColor(np.asarray(image.convert("RGB")), cv2.COLOR_RGB2BGR)
+
+
+def iter_pages(source, dpi=PDF_DPI):
+    """
+    :param source: str | bytes
+        Path or contents of a PDF, a TIFF or any image OpenCV can read
+    :param dpi: int
+        Resolution PDF pages are rasterized at
+    :return: generator of numpy.ndarray
+        BGR image of every page. Pages are read one at a time, only the
+        current one is kept in memory.
+    """
+
+    kind = document_type(source)
+    if kind == "pdf":
+        yield from _pdf_pages(source, dpi)
+        return
+    if kind == "tiff":
+        yield from _tiff_pages(source)
+        return
+
+    if isinstance(source, str):
+        img = cv2.imread(source)
+        if img is None:
+            raise ValueError("Could not read image: " + source)
+    else:
+        img = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_COLOR) if len(source) else None
+        if img is None:
+            raise ValueError("Could not decode image")
+
+    yield img
+
+
+def join_pages(texts):
+    """
+    :param texts: iterable of str
+        OCR result of every page
+    :return: str
+        Text of the whole document, every page starting on a new line
+    """
+
+    return "".join(text if text.endswith("\n") else text + "\n" for text in texts if text)
@@ -15,12 +15,22 @@
 # limitations under the License.
 
 
+import argparse
+import hashlib
+import json
+import math
 import os
+import shutil
+import sys
 import time
-from collections import defaultdict
-
-from terminaltables import SingleTable
-
+from collections import defaultdict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import chain, islice
+
+from receipt_parser_core.config import read_config, require_keys
+from receipt_parser_core.manifest import manifest_for_config
+from receipt_parser_core.metrics import instrumented, set_sink, sink_from_config
+from receipt_parser_core.profile import get_profile, profile_settings
 from receipt_parser_core.receipt import Receipt
 
 BASE_PATH = os.getcwd()
@@ -29,6 +39,17 @@ RESET = '\033[0m'
 
 STATS_OUTPUT_FORMAT = "{0:10.0f},{1:d},{2:d},{3:d},{4:d},\n"
 
+# Largest number of receipts sent to a worker at once
+CHUNK_SIZE = 64
+
+# Result of parse_many: position and path or lines of the input, and
+# either the receipt or the error it failed with
+ParseResult = namedtuple("ParseResult", ("index", "source", "receipt", "error"))
+
+# Set once per worker process by _init_parse_worker
+_worker_config = None
+_worker_keep_lines = True
+
 
 def get_files_in_folder(folder, include_hidden=False):
     """
@@ -93,12 +114,227 @@ def percent(numerator, denominator):
     return out + "%"
 
 
-def ocr_receipts(config, receipt_files):
+@instrumented("read_receipt")
+def read_receipt(config, receipt_path, keep_lines=True):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param receipt_path: str
+        Path to an OCR result
+    :param keep_lines: bool
+        Keep the lines in the receipt after parsing
+    :return: Receipt
+        Parsed receipt
+    """
+
+    with open(receipt_path, encoding="utf8", errors='ignore') as receipt:
+        return Receipt(config, receipt.readlines(), keep_lines)
+
+
+def _parse_source(config, source, keep_lines):
+    if isinstance(source, str):
+        return read_receipt(config, source, keep_lines)
+
+    return Receipt(config, list(source), keep_lines)
+
+
+def _parse_chunk(config, keep_lines, chunk):
+    """
+    Never raises, so one broken receipt can't abort the batch.
+    """
+
+    results = []
+    for index, source in chunk:
+        try:
+            results.append((index, _parse_source(config, source, keep_lines), None))
+        except Exception as e:
+            results.append((index, None, type(e).__name__ + ": " + str(e)))
+
+    return results
+
+
+def _init_parse_worker(config, keep_lines):
+    global _worker_config, _worker_keep_lines
+
+    _worker_config = config
+    _worker_keep_lines = keep_lines
+    # compile the patterns once per worker, not once per task
+    get_profile(config)
+
+
+def _parse_worker_chunk(chunk):
+    return _parse_chunk(_worker_config, _worker_keep_lines, chunk)
+
+
+def parse_many(config, sources, workers=None, chunksize=None, ordered=True, keep_lines=True):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param sources: iterable of str | [] of str
+        Paths of OCR results, or the lines of already read receipts
+    :param workers: int
+        Number of worker processes, defaults to the `workers` config
+        value, 0 means one per CPU core
+    :param chunksize: int
+        Number of receipts sent to a worker at once
+    :param ordered: bool
+        Return the results in the order of sources, otherwise as soon
+        as their chunk is done
+    :param keep_lines: bool
+        Keep the lines in the receipts after parsing
+    :return: generator of ParseResult
+        One result per source. The config is sent to every worker once,
+        a receipt that fails only sets the error of its own result.
+    """
+
+    if workers is None:
+        workers = getattr(config, "workers", 0)
+    workers = workers or os.cpu_count() or 1
+
+    if workers == 1:
+        # one at a time, without listing the sources first
+        for index, source in enumerate(sources):
+            for _, receipt, error in _parse_chunk(config, keep_lines, [(index, source)]):
+                yield ParseResult(index, source, receipt, error)
+        return
+
+    if chunksize is None:
+        # sized sources are spread evenly, iterators are never listed
+        size = len(sources) if hasattr(sources, "__len__") else CHUNK_SIZE * workers * 4
+        chunksize = max(1, min(CHUNK_SIZE, math.ceil(size / (workers * 4))))
+
+    tasks = enumerate(sources)
+    chunks = iter(lambda: list(islice(tasks, chunksize)), [])
+
+    first = next(chunks, None)
+    second = next(chunks, None)
+    if second is None:
+        # a single chunk is parsed right here
+        for index, source in first or []:
+            for _, receipt, error in _parse_chunk(config, keep_lines, [(index, source)]):
+                yield ParseResult(index, source, receipt, error)
+        return
+
+    profile = get_profile(config)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_parse_worker,
+                             initargs=(config, keep_lines)) as executor:
+        # only a few chunks are read and in flight, so neither the sources
+        # nor the results pile up faster than the caller consumes them
+        remaining = chain((first, second), chunks)
+        pending = {}
+        try:
+            while True:
+                for chunk in islice(remaining, workers * 2 - len(pending)):
+                    pending[executor.submit(_parse_worker_chunk, chunk)] = chunk
+                if not pending:
+                    break
+
+                if ordered:
+                    done = [next(iter(pending))]
+                else:
+                    done = wait(pending, return_when=FIRST_COMPLETED).done
+
+                for future in done:
+                    chunk = pending.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:  # worker process died
+                        error = type(e).__name__ + ": " + str(e)
+                        results = [(index, None, error) for index, _ in chunk]
+
+                    sources_of = dict(chunk)
+                    for index, receipt, error in results:
+                        if receipt is not None:
+                            # receipts are pickled without their profile
+                            receipt.profile = profile
+                        yield ParseResult(index, sources_of[index], receipt, error)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def iter_files_in_folder(folder, include_hidden=False):
+    """
+    :param folder: str
+        Path to folder to list
+    :param include_hidden: bool
+        True iff you want also hidden files
+    :return: generator of str
+        Full path of files in folder, without listing the whole folder first
+    """
+
+    with os.scandir(os.path.join(BASE_PATH, folder)) as entries:
+        for entry in entries:
+            if not include_hidden and entry.name.startswith("."):
+                continue
+
+            if entry.is_file():
+                yield os.path.join(folder, entry.name)
+
+
+def update_stats(stats, receipt):
+    """
+    :param stats: {}
+        Statistics details
+    :param receipt: Receipt
+        Parsed receipt
+    :return: void
+        Counts the receipt and the fields found in it
+    """
+
+    stats["total"] += 1
+    if receipt.market:
+        stats["market"] += 1
+    if receipt.date:
+        stats["date"] += 1
+    if receipt.sum:
+        stats["sum"] += 1
+
+
+def iter_receipts(config, receipt_files, stats=None, keep_lines=True, workers=1, manifest=None):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param receipt_files: iterable of str
+        Files to parse
+    :param stats: {}
+        Updated with every receipt, see update_stats
+    :param keep_lines: bool
+        Keep the lines in the receipts after parsing
+    :param workers: int
+        Number of worker processes, see parse_many
+    :param manifest: Manifest
+        Every file is recorded in it once the caller is done with it,
+        without outputs of its own
+    :return: generator of (str, Receipt)
+        Path and receipt in the order of receipt_files, files that can
+        not be parsed are reported and skipped
+    """
+
+    for _, receipt_path, receipt, error in parse_many(config, receipt_files, workers, keep_lines=keep_lines):
+        if error is not None:
+            print(ORANGE + '~: ' + RESET + 'Failed: ' + receipt_path + ': ' + error, file=sys.stderr)
+            continue
+
+        if stats is not None:
+            update_stats(stats, receipt)
+
+        yield receipt_path, receipt
+
+        if manifest is not None:
+            manifest.record(receipt_path, receipt_path)
+
+
+def ocr_receipts(config, receipt_files, workers=1, manifest=None):
     """
     :param config: ObjectView
         Parsed config file
     :param receipt_files: [] of str
         List of files to parse
+    :param workers: int
+        Number of worker processes, see iter_receipts
+    :param manifest: Manifest
+        Records the parsed files with their JSON results
     :return: {}
         Stats about files
     """
@@ -109,31 +345,24 @@ def ocr_receipts(config, receipt_files):
         ['Path', 'Market', "Date", "Items", "SUM"],
     ]
 
-    if config.results_as_json:
-        results_to_json(config, receipt_files)
+    for receipt_path, receipt in iter_receipts(config, receipt_files, stats, workers=workers):
+        if config.results_as_json:
+            write_json(receipt_path, receipt)
+            if manifest is not None:
+                manifest.record(receipt_path, receipt_path, [receipt_path + ".json"])
 
-    for receipt_path in receipt_files:
-        with open(receipt_path, encoding="utf8", errors='ignore') as receipt:
-            receipt = Receipt(config, receipt.readlines())
+        item_list = ""
+        for item in receipt.items:
+            if not item:
+                continue
 
-            item_list = ""
-            for item in receipt.items:
-                if not item:
-                    continue
+            item_list += ' '.join(item) + "\n"
 
-                item_list += ' '.join(item) + "\n"
+        table_data.append(
+            [receipt_path, receipt.market, receipt.date, item_list, receipt.sum]
+        )
 
-            table_data.append(
-                [receipt_path, receipt.market, receipt.date, item_list, receipt.sum]
-            )
-
-            stats["total"] += 1
-            if receipt.market:
-                stats["market"] += 1
-            if receipt.date:
-                stats["date"] += 1
-            if receipt.sum:
-                stats["sum"] += 1
+    from terminaltables import SingleTable
 
     table = SingleTable(table_data)
     print(table.table)
@@ -141,10 +370,263 @@ def ocr_receipts(config, receipt_files):
     return stats
 
 
+def write_json(receipt_path, receipt):
+    """
+    :param receipt_path: str
+        Path of the parsed file
+    :param receipt: Receipt
+        Parsed receipt
+    :return: void
+        Writes the receipt next to the parsed file
+    """
+
+    with open(receipt_path + ".json", "w") as out:
+        out.write(receipt.to_json())
+
+
 def results_to_json(config, receipt_files):
-    for receipt_path in receipt_files:
-        with open(receipt_path, encoding="utf8", errors='ignore') as receipt:
-            receipt = Receipt(config, receipt.readlines())
-            out = open(receipt_path + ".json", "w")
-            out.write(receipt.to_json())
-            out.close()
+    for receipt_path, receipt in iter_receipts(config, receipt_files):
+        write_json(receipt_path, receipt)
+
+
+def write_json_lines(config, receipt_files, out, workers=1, manifest=None):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param receipt_files: iterable of str
+        Files to parse
+    :param out: file
+        Stream to write to
+    :param workers: int
+        Number of worker processes, see iter_receipts
+    :param manifest: Manifest
+        Records the parsed files, see iter_receipts
+    :return: {}
+        Stats about files
+    """
+
+    stats = defaultdict(int)
+
+    for receipt_path, receipt in iter_receipts(config, receipt_files, stats, workers=workers, manifest=manifest):
+        object_data = receipt.to_dict()
+        object_data["path"] = receipt_path
+
+        out.write(json.dumps(object_data) + "\n")
+
+    out.flush()
+
+    return stats
+
+
+def update_json_lines(config, receipt_files, path, append=False, workers=1, manifest=None, superseded=()):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param receipt_files: iterable of str
+        Files to parse
+    :param path: str
+        JSON lines file to write to
+    :param append: bool
+        Keep the records already in the file, they are replaced otherwise
+    :param workers: int
+        Number of worker processes, see iter_receipts
+    :param manifest: Manifest
+        Records the parsed files, see iter_receipts
+    :param superseded: iterable of str
+        Paths of receipts whose old records are dropped from the file.
+        Only read once all receipts are written, so it may be filled
+        while receipt_files is consumed.
+    :return: {}
+        Stats about files
+    """
+
+    if not append:
+        with open(path, "w", encoding="utf-8") as out:
+            return write_json_lines(config, receipt_files, out, workers, manifest)
+
+    # new records are only added to the file once the old ones are dropped
+    new_path = path + ".new"
+    try:
+        with open(new_path, "w", encoding="utf-8") as out:
+            return write_json_lines(config, receipt_files, out, workers, manifest)
+    finally:
+        _merge_json_lines(path, new_path, set(superseded))
+
+
+def _merge_json_lines(path, new_path, superseded):
+    if not superseded:
+        with open(path, "a", encoding="utf-8") as out, open(new_path, encoding="utf-8") as new:
+            shutil.copyfileobj(new, out)
+        os.remove(new_path)
+        return
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        with open(path, encoding="utf-8") as old:
+            for line in old:
+                try:
+                    receipt_path = json.loads(line).get("path")
+                except ValueError:
+                    receipt_path = None
+                if receipt_path not in superseded:
+                    out.write(line)
+
+        with open(new_path, encoding="utf-8") as new:
+            shutil.copyfileobj(new, out)
+
+    os.replace(tmp_path, path)
+    os.remove(new_path)
+
+
+def export_receipts(config, receipt_files, folder, export_format=None, append=False, workers=1, manifest=None,
+                    superseded=()):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param receipt_files: iterable of str
+        Files to parse
+    :param folder: str
+        Folder to write the receipts and items tables to
+    :param export_format: str
+        parquet or npz, see receipt_parser_core.export
+    :param append: bool
+        Add to the tables already in folder instead of replacing them
+    :param workers: int
+        Number of worker processes, see iter_receipts
+    :param manifest: Manifest
+        Records the parsed files, see iter_receipts
+    :param superseded: iterable of str
+        Paths of receipts whose old rows are dropped from the tables,
+        see update_json_lines
+    :return: {}
+        Stats about files
+    """
+
+    from receipt_parser_core.export import CHUNK_SIZE, ColumnarExport
+
+    stats = defaultdict(int)
+    chunk_size = getattr(config, "export_chunk_size", CHUNK_SIZE)
+
+    with ColumnarExport(folder, export_format, chunk_size, append) as export:
+        try:
+            for receipt_path, receipt in iter_receipts(config, receipt_files, stats, False, workers, manifest):
+                export.add(receipt_path, receipt)
+        finally:
+            export.drop(superseded)
+
+    return stats
+
+
+def add_parse_arguments(parser):
+    """
+    :param parser: argparse.ArgumentParser
+        Parser to add the options of the parse step to
+    :return: void
+    """
+
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="number of worker processes (0 = one per CPU core, default: `workers` in config.yml)")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--jsonl", metavar="FILE", default=None,
+                        help="stream results as JSON lines to FILE (- for stdout) instead of printing a table")
+    output.add_argument("--export", metavar="FOLDER", default=None,
+                        help="write receipts and items as columnar tables to FOLDER instead of printing a table")
+    parser.add_argument("--export-format", choices=("parquet", "npz"), default=None,
+                        help="format of --export (default: parquet if pyarrow is installed, else npz)")
+    parser.add_argument("--force", action="store_true",
+                        help="process all receipts, not only new or changed ones")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete the results of removed receipts")
+
+
+def _output_manifest(config, output, kind):
+    # every output file remembers on its own which receipts are in it
+    name = hashlib.sha256(os.path.abspath(output).encode("utf-8")).hexdigest()[:16]
+    return manifest_for_config(config, "parse-%s-%s" % (kind, name), profile_settings(config))
+
+
+def _pending(manifest, receipt_files, superseded):
+    # changed receipts already have a record in the output
+    for receipt_path in manifest.iter_pending(receipt_files):
+        if receipt_path in manifest:
+            superseded.append(receipt_path)
+        yield receipt_path
+
+
+def parse_receipts(config, args):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :param args: argparse.Namespace
+        Options added by add_parse_arguments
+    :return: {}
+        Parses the receipts in receipts_path and returns stats about
+        them. The table lists all receipts. A --jsonl file or --export
+        folder only gets the receipts that are new or changed since it
+        was last written (all of them without a manifest or with
+        --force), their old records are replaced.
+    """
+
+    require_keys(config, "receipts_path")
+    export = getattr(args, "export", None)
+    workers = getattr(args, "workers", None)
+    prune = getattr(args, "prune", False)
+
+    if not args.jsonl and not export:
+        # the manifest only remembers the JSON results, so --prune can delete them
+        manifest = None
+        if config.results_as_json:
+            manifest = manifest_for_config(config, "parse", profile_settings(config))
+
+        try:
+            if manifest is not None and prune:
+                manifest.prune_missing()
+            return ocr_receipts(config, get_files_in_folder(config.receipts_path), workers, manifest)
+        finally:
+            if manifest is not None:
+                manifest.save()
+
+    receipt_files = iter_files_in_folder(config.receipts_path)
+    if args.jsonl == "-":
+        return write_json_lines(config, receipt_files, sys.stdout, workers)
+
+    if export:
+        from receipt_parser_core.export import default_format
+
+        export_format = args.export_format or default_format()
+        manifest = _output_manifest(config, export, "export-" + export_format)
+    else:
+        manifest = _output_manifest(config, args.jsonl, "jsonl")
+
+    superseded = []
+    append = manifest is not None and not getattr(args, "force", False) and os.path.exists(export or args.jsonl)
+    if manifest is not None and prune:
+        removed = manifest.prune_missing()
+        if append:
+            superseded.extend(removed)
+    if append:
+        receipt_files = _pending(manifest, receipt_files, superseded)
+
+    try:
+        if export:
+            return export_receipts(config, receipt_files, export, export_format, append, workers, manifest, superseded)
+
+        return update_json_lines(config, receipt_files, args.jsonl, append, workers, manifest, superseded)
+    finally:
+        if manifest is not None:
+            manifest.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse OCRed receipts")
+    add_parse_arguments(parser)
+    args = parser.parse_args()
+
+    config = read_config()
+    set_sink(sink_from_config(config))
+
+    parse_receipts(config, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fnmatch
+import re
+import threading
+import weakref
+
+from receipt_parser_core.matcher import MarketMatcher
+
+_profiles = weakref.WeakKeyDictionary()
+_profiles_lock = threading.Lock()
+
+# Config values parsed receipts depend on
+PROFILE_SETTINGS = ("markets", "date_format", "sum_format", "item_format", "ignore_keys", "sum_keys")
+
+# Config values a market can override as <key>_<market>, see ObjectView.get_config
+MARKET_SETTINGS = ("item_format", "ignore_keys", "sum_keys")
+
+
+def profile_settings(config):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :return: [] of str
+        Keys of the config values parsed receipts depend on, including
+        the overrides of every market
+    """
+
+    return list(PROFILE_SETTINGS) + [
+        key + "_" + market.lower() for market in config.markets for key in MARKET_SETTINGS
+    ]
+
+
+def keyword_pattern(keywords):
+    """
+    :param keywords: [] of str
+        Glob patterns a line has to contain
+    :return: re.Pattern
+        One alternation that finds a line iff fnmatch(line, f"*{keyword}*")
+        is true for any keyword, None if there are no keywords
+    """
+
+    alternatives = []
+    for keyword in keywords:
+        if any(char in keyword for char in "*?["):
+            alternatives.append(fnmatch.translate(f"*{keyword}*"))
+        else:
+            alternatives.append(re.escape(keyword))
+
+    if not alternatives:
+        return None
+
+    return re.compile("|".join(alternatives))
+
+
+class MarketProfile(object):
+    """ Compiled item settings of a single market, read-only """
+
+    __slots__ = ("item_pattern", "ignore_pattern", "stop_pattern")
+
+    def __init__(self, item_format, ignore_keys, sum_keys):
+        """
+        :param item_format: str
+            Regex of an item line
+        :param ignore_keys: [] of str
+            Lines containing these are skipped
+        :param sum_keys: [] of str
+            Lines containing these end the item list
+        """
+
+        object.__setattr__(self, "item_pattern", re.compile(item_format))
+        object.__setattr__(self, "ignore_pattern", keyword_pattern(ignore_keys))
+        object.__setattr__(self, "stop_pattern", keyword_pattern(sum_keys))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("MarketProfile is read-only")
+
+
+class ParserProfile(object):
+    """ Everything Receipt needs from a config, compiled once """
+
+    def __init__(self, config):
+        """
+        :param config: ObjectView
+            Parsed config file
+        """
+
+        self.config = config
+        self.date_pattern = re.compile(config.date_format)
+        self.sum_pattern = re.compile(config.sum_format)
+        self.market_matcher = MarketMatcher(config.markets)
+
+        # settings of every known market are resolved up front, so
+        # looking them up while parsing is a single dict access
+        self._markets = {market: self._resolve(market) for market in (None, *config.markets)}
+        self._lock = threading.Lock()
+
+    def _resolve(self, market):
+        return MarketProfile(
+            self.config.get_config("item_format", market),
+            self.config.get_config("ignore_keys", market),
+            self.config.get_config("sum_keys", market),
+        )
+
+    def market(self, market):
+        """
+        :param market: str
+            Market name, None for the default settings
+        :return: MarketProfile
+            Item settings of the market, see ObjectView.get_config
+        """
+
+        profile = self._markets.get(market)
+        if profile is None:
+            with self._lock:
+                profile = self._markets.get(market)
+                if profile is None:
+                    profile = self._resolve(market)
+                    self._markets[market] = profile
+
+        return profile
+
+
+def get_profile(config):
+    """
+    :param config: ObjectView
+        Parsed config file
+    :return: ParserProfile
+        Profile of config, compiled on first use
+    """
+
+    profile = _profiles.get(config)
+    if profile is None:
+        with _profiles_lock:
+            profile = _profiles.get(config)
+            if profile is None:
+                profile = ParserProfile(config)
+                _profiles[config] = profile
+
+    return profile
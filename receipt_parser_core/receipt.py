@@ -14,35 +14,77 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import fnmatch
 import json
-import re
+from array import array
 from collections import namedtuple
-from difflib import get_close_matches
 
-import dateutil.parser
+from receipt_parser_core.matcher import TokenizedLines
+from receipt_parser_core.metrics import instrumented
+from receipt_parser_core.profile import get_profile
+
+
+# Article and price of a receipt line
+Item = namedtuple("Item", ("article", "sum"))
+
+
+def _line_count(receipt, *args, **kwargs):
+    return (len(receipt.lines),)
 
 
 class Receipt(object):
     """ Market receipt to be parsed """
 
-    def __init__(self, config, raw):
+    __slots__ = ("profile", "market", "date", "sum", "items", "lines", "_tokens", "_tokenized_lines")
+
+    def __init__(self, config, raw, keep_lines=True):
         """
         :param config: ObjectView
             Config object
         :param raw: [] of str
             Lines in file
+        :param keep_lines: bool
+            Keep the normalized lines after parsing, False to only keep
+            the parsed fields
         """
 
-        self.config = config
+        self.profile = get_profile(config)
         self.market = None
         self.date = None
         self.sum = None
         self.items = None
         self.lines = raw
+        self._tokens = None
+        self._tokenized_lines = None
         self.normalize()
         self.parse()
 
+        # the words are only needed while parsing, they are split again
+        # if the receipt is searched later
+        self._tokens = None
+        self._tokenized_lines = None
+        if not keep_lines:
+            self.lines = ()
+
+    @property
+    def config(self):
+        """
+        :return: ObjectView
+            Config object, shared with the parser profile
+        """
+
+        return self.profile.config
+
+    def __getstate__(self):
+        # the profile holds the config and the compiled patterns, it is
+        # attached again by whoever unpickles the receipt
+        return self.market, self.date, self.sum, self.items, self.lines
+
+    def __setstate__(self, state):
+        self.market, self.date, self.sum, self.items, self.lines = state
+        self.profile = None
+        self._tokens = None
+        self._tokenized_lines = None
+
     def normalize(self):
         """
         :return: void
@@ -55,7 +97,23 @@ class Receipt(object):
         self.lines = [
             line.lower() for line in self.lines if line.strip()
         ]
+        self._tokens = TokenizedLines(self.lines)
+        self._tokenized_lines = self.lines
 
+    @property
+    def tokens(self):
+        """
+        :return: TokenizedLines
+            Words of lines, split again only if lines was replaced
+        """
+
+        if self._tokens is None or self._tokenized_lines is not self.lines or len(self._tokens.offsets) != len(self.lines) + 1:
+            self._tokens = TokenizedLines(self.lines)
+            self._tokenized_lines = self.lines
+
+        return self._tokens
+
+    @instrumented("parse", shape=_line_count)
     def parse(self):
         """
         :return: void
@@ -63,9 +121,8 @@ class Receipt(object):
         """
 
         self.market = self.parse_market()
-        self.date = self.parse_date()
         self.sum = self.parse_sum()
-        self.items = self.parse_items()
+        self.date, self.items = self.scan_lines()
 
     def fuzzy_find(self, keyword, accuracy=0.6):
         """
@@ -78,56 +135,53 @@ class Receipt(object):
             It runs a fuzzy match if 0 < accuracy < 1.0
         """
 
-        for line in self.lines:
-            words = line.split()
-            # Get the single best match in line
-            matches = get_close_matches(keyword, words, 1, accuracy)
-            if matches:
-                return line
+        index = self.tokens.find(keyword, accuracy)
+        if index is not None:
+            return self.lines[index]
 
-    def parse_date(self):
+    @instrumented("scan_lines", shape=_line_count)
+    def scan_lines(self, date=True, items=True):
         """
-        :return: date
-            Parses data
+        :param date: bool
+            Look for the date
+        :param items: bool
+            Collect the items, needs the market
+        :return: (str, [] of item)
+            Date and items, parsed in one pass over the lines that
+            stops as soon as both are done
         """
 
-        for line in self.lines:
-            match = re.search(self.config.date_format, line)
-            if match:  # We"re happy with the first match for now
-                # validate date using the dateutil library (see: https://dateutil.readthedocs.io/)
-                date_str = match.group(1)
-                date_str = date_str.replace(" ", "")
-                try:
-                    dateutil.parser.parse(date_str)
-                except ValueError:
-                    return None
-
-                return date_str
+        date_str, date_done = None, not date
+        item_list, items_done = [], not items
+        date_pattern = self.profile.date_pattern
 
-    def parse_items(self):
-        items = []
-        item = namedtuple("item", ("article", "sum"))
-
-        ignored_words = self.config.get_config("ignore_keys", self.market)
-        stop_words = self.config.get_config("sum_keys", self.market)
-        item_format = self.config.get_config("item_format", self.market)
+        if items:
+            market_profile = self.profile.market(self.market)
+            ignore_pattern = market_profile.ignore_pattern
+            stop_pattern = market_profile.stop_pattern if self.market != "Metro" else None
+            item_pattern = market_profile.item_pattern
 
         for line in self.lines:
-            parse_stop = None
-            for ignore_word in ignored_words:
-                parse_stop = fnmatch.fnmatch(line, f"*{ignore_word}*")
-                if parse_stop:
-                    break
+            if date_done and items_done:
+                break
+
+            if not date_done:
+                match = date_pattern.search(line)
+                if match:  # We"re happy with the first match for now
+                    date_done = True
+                    date_str = self._validate_date(match)
+
+            if items_done:
+                continue
 
-            if parse_stop:
+            if ignore_pattern is not None and ignore_pattern.search(line):
                 continue
 
-            if self.market != "Metro":
-                for stop_word in stop_words:
-                    if fnmatch.fnmatch(line, f"*{stop_word}*"):
-                        return items
+            if stop_pattern is not None and stop_pattern.search(line):
+                items_done = True
+                continue
 
-            match = re.search(item_format, line)
+            match = item_pattern.search(line)
             if hasattr(match, 'group'):
                 article_name = match.group(1)
 
@@ -135,33 +189,48 @@ class Receipt(object):
                     article_sum = "-" + match.group(3).replace(",", ".")
                 else:
                     article_sum = match.group(3).replace(",", ".")
-            else:
-                continue
 
-            items.append(item(article_name, article_sum))
+                item_list.append(Item(article_name, article_sum))
+
+        return date_str, item_list
+
+    @staticmethod
+    def _validate_date(match):
+        # validate date using the dateutil library (see: https://dateutil.readthedocs.io/)
+        import dateutil.parser
+
+        date_str = match.group(1)
+        date_str = date_str.replace(" ", "")
+        try:
+            dateutil.parser.parse(date_str)
+        except ValueError:
+            return None
+
+        return date_str
+
+    @instrumented("parse_date", shape=_line_count)
+    def parse_date(self):
+        """
+        :return: date
+            Parses data
+        """
 
-        return items
+        return self.scan_lines(items=False)[0]
 
+    @instrumented("parse_items", shape=_line_count)
+    def parse_items(self):
+        return self.scan_lines(date=False)[1]
+
+    @instrumented("parse_market", shape=_line_count)
     def parse_market(self):
         """
         :return: str
             Parses market data
         """
 
-        for int_accuracy in range(10, 6, -1):
-            accuracy = int_accuracy / 10.0
-
-            min_accuracy, market_match = -1, None
-            for market, spellings in self.config.markets.items():
-                for spelling in spellings:
-                    line = self.fuzzy_find(spelling, accuracy)
-                    if line and (accuracy < min_accuracy or min_accuracy == -1):
-                        min_accuracy = accuracy
-                        market_match = market
-                        return market_match
-
-        return market_match
+        return self.profile.market_matcher.match(self.tokens)
 
+    @instrumented("parse_sum", shape=_line_count)
     def parse_sum(self):
         """
         :return: str
@@ -175,16 +244,16 @@ class Receipt(object):
                 # finding and parsing the sum easier
                 sum_line = sum_line.replace(",", ".")
                 # Parse the sum
-                sum_float = re.search(self.config.sum_format, sum_line)
+                sum_float = self.profile.sum_pattern.search(sum_line)
                 if sum_float:
                     return sum_float.group(0)
 
-    def to_json(self):
+    def to_dict(self):
         """
-        :return: json
-            Convert Receipt object to json
+        :return: {}
+            Receipt data as plain dict
         """
-        object_data = {
+        return {
             "market": self.market,
             "date": self.date,
             "sum": self.sum,
@@ -192,4 +261,139 @@ class Receipt(object):
             "lines": self.lines
         }
 
-        return json.dumps(object_data)
+    def to_json(self):
+        """
+        :return: json
+            Convert Receipt object to json
+        """
+        return json.dumps(self.to_dict())
+
+
+class ReceiptBatch(object):
+    """ Parsed receipts stored column by column, for keeping many of them in memory """
+
+    __slots__ = (
+        "keep_lines", "markets", "dates", "sums", "item_offsets", "articles", "item_sums",
+        "_texts", "_line_offsets", "_line_ends",
+    )
+
+    def __init__(self, receipts=(), keep_lines=False):
+        """
+        :param receipts: iterable of Receipt
+            Receipts to add
+        :param keep_lines: bool
+            Also keep the lines of the receipts
+        """
+
+        self.keep_lines = keep_lines
+        self.markets = []
+        self.dates = []
+        self.sums = []
+        # items of receipt i are articles[item_offsets[i]:item_offsets[i + 1]]
+        self.item_offsets = array("L", [0])
+        self.articles = []
+        self.item_sums = []
+        # the lines of a receipt are kept as one string and the ends of its lines
+        self._texts = []
+        self._line_offsets = array("L", [0])
+        self._line_ends = array("L")
+
+        self.extend(receipts)
+
+    def __len__(self):
+        return len(self.markets)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.to_dict(index)
+
+    def append(self, receipt):
+        """
+        :param receipt: Receipt
+            Parsed receipt
+        :return: void
+        """
+
+        self.markets.append(receipt.market)
+        self.dates.append(receipt.date)
+        self.sums.append(receipt.sum)
+
+        items = receipt.items or ()
+        self.articles.extend(item[0] for item in items)
+        self.item_sums.extend(item[1] for item in items)
+        self.item_offsets.append(len(self.articles))
+
+        if self.keep_lines:
+            end = 0
+            for line in receipt.lines:
+                end += len(line)
+                self._line_ends.append(end)
+            self._texts.append("".join(receipt.lines))
+        self._line_offsets.append(len(self._line_ends))
+
+    def extend(self, receipts):
+        """
+        :param receipts: iterable of Receipt
+            Parsed receipts
+        :return: void
+        """
+
+        for receipt in receipts:
+            self.append(receipt)
+
+    def items(self, index):
+        """
+        :param index: int
+            Position of the receipt
+        :return: [] of Item
+            Items of the receipt
+        """
+
+        start, end = self.item_offsets[index], self.item_offsets[index + 1]
+        return [Item(article, item_sum) for article, item_sum in zip(self.articles[start:end], self.item_sums[start:end])]
+
+    def lines(self, index):
+        """
+        :param index: int
+            Position of the receipt
+        :return: [] of str
+            Normalized lines of the receipt, empty unless keep_lines
+        """
+
+        if not self.keep_lines:
+            return []
+
+        text = self._texts[index]
+        start = 0
+        lines = []
+        for end in self._line_ends[self._line_offsets[index]:self._line_offsets[index + 1]]:
+            lines.append(text[start:end])
+            start = end
+
+        return lines
+
+    def to_dict(self, index):
+        """
+        :param index: int
+            Position of the receipt
+        :return: {}
+            Receipt data as plain dict, the same as Receipt.to_dict
+        """
+
+        return {
+            "market": self.markets[index],
+            "date": self.dates[index],
+            "sum": self.sums[index],
+            "items": self.items(index),
+            "lines": self.lines(index)
+        }
+
+    def to_json(self, index):
+        """
+        :param index: int
+            Position of the receipt
+        :return: json
+            Receipt data as json, the same as Receipt.to_json
+        """
+
+        return json.dumps(self.to_dict(index))
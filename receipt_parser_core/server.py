@@ -0,0 +1,270 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Long running HTTP server with a warm pipeline:
+
+    POST /image    encoded receipt image, PDF or TIFF, returns the parsed receipt as JSON.
+                   ?fields=market,date,sum only OCRs the lines these fields are on
+    POST /text     OCRed receipt text, returns the parsed receipt as JSON
+    GET  /metrics  request latency, queue depth and stage durations
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from receipt_parser_core.config import read_config
+from receipt_parser_core.metrics import PrometheusSink, StageEvent, get_sink, set_sink, sink_from_config
+from receipt_parser_core.profile import get_profile
+from receipt_parser_core.receipt import Receipt
+
+
+class QueueFull(Exception):
+    """ Raised when more requests wait than the queue allows """
+
+
+class ReceiptServer(ThreadingHTTPServer):
+    """ HTTP server that keeps config, patterns and OCR engines loaded """
+
+    daemon_threads = True
+
+    def __init__(self, address, config, max_concurrency=None, queue_size=None):
+        """
+        :param address: (str, int)
+            Host and port to listen on
+        :param config: ObjectView
+            Parsed config file
+        :param max_concurrency: int
+            Number of requests processed at the same time, defaults to
+            the number of CPU cores
+        :param queue_size: int
+            Number of requests that may wait, more are rejected with 503
+        """
+
+        super().__init__(address, ReceiptRequestHandler)
+
+        self.config = config
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.queue_size = self.max_concurrency * 4 if queue_size is None else queue_size
+
+        self.requests = PrometheusSink(
+            metric="request_seconds", label="endpoint", description="Latency of the HTTP requests"
+        )
+        self.in_flight = 0
+        self.waiting = 0
+
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+
+        # every request gets a new thread, the work is handed to these
+        # long lived ones so the tesseract instance each keeps is reused
+        self._workers = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="receipt-worker")
+
+    def warm_up(self, images=True):
+        """
+        :param images: bool
+            Also load the image stack and the OCR engine
+        :return: void
+            Loads everything the first request would otherwise have to,
+            including the tesseract instance of every worker thread
+        """
+
+        get_profile(self.config)
+        if images:
+            import receipt_parser_core.enhancer  # noqa: F401
+            from receipt_parser_core.ocr import engine_for_config
+
+            engine = engine_for_config(self.config)
+            # the barrier keeps every task on a thread of its own
+            barrier = threading.Barrier(self.max_concurrency)
+
+            def warm_up_worker():
+                barrier.wait()
+                engine.warm_up()
+
+            for future in [self._workers.submit(warm_up_worker) for _ in range(self.max_concurrency)]:
+                future.result()
+
+    def process(self, function, *args):
+        """
+        :param function: callable
+            Work to do once a slot is free
+        :return: object
+            Result of function, raises QueueFull if too many requests wait
+        """
+
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.queue_size:
+                    raise QueueFull()
+                self.waiting += 1
+
+            try:
+                self._slots.acquire()
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            return self._workers.submit(function, *args).result()
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._workers.shutdown(wait=False)
+
+    def render_metrics(self):
+        """
+        :return: str
+            Prometheus text of the request latency, the queue depth and,
+            if they are collected here, the stage durations
+        """
+
+        with self._lock:
+            waiting, in_flight = self.waiting, self.in_flight
+
+        text = self.requests.render()
+        text += "# HELP receipt_parser_queue_depth Requests waiting for a free slot\n"
+        text += "# TYPE receipt_parser_queue_depth gauge\n"
+        text += "receipt_parser_queue_depth %d\n" % waiting
+        text += "# HELP receipt_parser_in_flight Requests being processed\n"
+        text += "# TYPE receipt_parser_in_flight gauge\n"
+        text += "receipt_parser_in_flight %d\n" % in_flight
+
+        sink = get_sink()
+        if isinstance(sink, PrometheusSink):
+            text += sink.render()
+
+        return text
+
+
+def _parse_image(config, data, fields=None):
+    if fields:
+        from receipt_parser_core.extract import extract_image_bytes
+
+        return extract_image_bytes(config, data, fields)
+
+    from receipt_parser_core.enhancer import process_image_bytes
+
+    return process_image_bytes(config, data)
+
+
+def _parse_text(config, data, fields=None):
+    # the text is already OCRed, parsing all of it is cheap
+    return Receipt(config, data.decode("utf-8", errors="ignore").splitlines(keepends=True))
+
+
+class ReceiptRequestHandler(BaseHTTPRequestHandler):
+    """ Handles the requests of a ReceiptServer """
+
+    endpoints = {
+        "/image": _parse_image,
+        "/text": _parse_text,
+    }
+
+    def _send(self, status, body, content_type="application/json"):
+        body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps({"error": message}))
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        endpoint = self.endpoints.get(url.path)
+        if endpoint is None:
+            return self._send_error(404, "Unknown endpoint: " + url.path)
+
+        fields = [field for value in parse_qs(url.query).get("fields", ()) for field in value.split(",") if field]
+
+        start = time.perf_counter()
+        status, outcome = 200, "ok"
+        try:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = self.server.process(endpoint, self.server.config, data, fields).to_json()
+        except QueueFull:
+            status, outcome, body = 503, "rejected", "Too many requests waiting"
+        except ValueError as e:
+            status, outcome, body = 400, "invalid", str(e)
+        except Exception as e:
+            status, outcome, body = 500, "error", type(e).__name__ + ": " + str(e)
+
+        duration = time.perf_counter() - start
+        self.server.requests.emit(StageEvent(url.path, duration, None, outcome))
+
+        if status == 200:
+            self._send(status, body)
+        else:
+            self._send_error(status, body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            return self._send(200, self.server.render_metrics(), "text/plain; version=0.0.4")
+        if self.path == "/health":
+            return self._send(200, json.dumps({"status": "ok"}))
+
+        self._send_error(404, "Unknown endpoint: " + self.path)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--config", default="config.yml")
+    parser.add_argument("-w", "--workers", type=int, default=None,
+                        help="requests processed at the same time (default: one per CPU core)")
+    parser.add_argument("--queue-size", type=int, default=None,
+                        help="requests that may wait for a free worker, more get a 503")
+    args = parser.parse_args()
+
+    config = read_config(args.config)
+    if getattr(config, "metrics", None) in (None, "none", "prometheus"):
+        # stage durations are served at /metrics next to the request metrics
+        set_sink(PrometheusSink())
+    else:
+        set_sink(sink_from_config(config))
+
+    server = ReceiptServer((args.host, args.port), config, args.workers, args.queue_size)
+    server.warm_up()
+
+    print("Serving receipt parser on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import threading
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+
+from receipt_parser_core.aio import AsyncReceiptParser
+from receipt_parser_core.config import read_config
+
+
+class BlockingLines(object):
+    """ Receipt lines that can only be read once released """
+
+    def __init__(self, lines, release):
+        self.lines = lines
+        self.release = release
+
+    def __iter__(self):
+        self.release.wait(5)
+        return iter(self.lines)
+
+
+class AsyncReceiptParserTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.aio`."""
+
+    config = read_config(os.getcwd() + "/config.yml")
+
+    def setUp(self):
+        self.parser = AsyncReceiptParser(self.config, max_concurrency=1, queue_size=1)
+        self.addCleanup(self.parser.close)
+
+    def test_parse_text(self):
+        receipt = asyncio.run(self.parser.parse_text(["penny\n", "summe 4,99\n"]))
+
+        self.assertEqual("Penny", receipt.market)
+        self.assertEqual("4.99", receipt.sum)
+
+    def test_process_pool(self):
+        with ProcessPoolExecutor(1) as executor:
+            parser = AsyncReceiptParser(self.config, executor=executor)
+            receipt = asyncio.run(parser.parse_text(["penny\n", "summe 4,99\n"]))
+
+        self.assertEqual("4.99", receipt.sum)
+        self.assertIs(self.config, receipt.config)
+
+    def test_backpressure(self):
+        release = threading.Event()
+
+        async def run():
+            running = asyncio.ensure_future(self.parser.parse_text(BlockingLines(["penny\n"], release)))
+            queued = asyncio.ensure_future(self.parser.parse_text(["rewe\n"]))
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(2, self.parser.pending)
+            with self.assertRaises(asyncio.QueueFull):
+                await self.parser.parse_text(["aldi\n"], block=False)
+
+            release.set()
+            return await running, await queued
+
+        first, second = asyncio.run(run())
+        self.assertEqual("Penny", first.market)
+        self.assertEqual("REWE", second.market)
+        self.assertEqual(0, self.parser.pending)
+
+    def test_timeout(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        async def run():
+            await self.parser.parse_text(BlockingLines([], release), timeout=0.05)
+
+        self.assertRaises(asyncio.TimeoutError, asyncio.run, run())
+
+    def test_parse_images_isolates_failures(self):
+        async def run():
+            return [result async for result in self.parser.parse_images([b"not an image", b""])]
+
+        results = asyncio.run(run())
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2
+import numpy as np
+
+from receipt_parser_core import enhancer
+from receipt_parser_core.cache import OcrCache
+from receipt_parser_core.config import FrozenConfig, _thaw, read_config
+
+
+class OcrCacheTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.cache`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def test_key(self):
+        key = OcrCache.key(b"image", language="deu", rotate=True)
+
+        self.assertEqual(key, OcrCache.key(b"image", rotate=True, language="deu"))
+        self.assertNotEqual(key, OcrCache.key(b"image", language="eng", rotate=True))
+        self.assertNotEqual(key, OcrCache.key(b"other", language="deu", rotate=True))
+
+    def test_hit_and_miss(self):
+        cache = OcrCache(self.tmp_dir.name)
+        key = OcrCache.key(b"image")
+
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "summe 4,99\n")
+        self.assertEqual("summe 4,99\n", cache.get(key))
+
+        stats = cache.stats()
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["misses"])
+
+        # results survive a restart
+        self.assertEqual("summe 4,99\n", OcrCache(self.tmp_dir.name).get(key))
+
+    def test_lru_eviction(self):
+        cache = OcrCache(self.tmp_dir.name, max_size=2500 / (1024 * 1024))
+        first, second, third = (OcrCache.key(data) for data in (b"1", b"2", b"3"))
+
+        cache.put(first, "x" * 1000)
+        cache.put(second, "x" * 1000)
+        cache.get(first)
+        cache.put(third, "x" * 1000)
+
+        self.assertIsNotNone(cache.get(first))
+        self.assertIsNone(cache.get(second))
+        self.assertIsNotNone(cache.get(third))
+
+
+class CountingEngine(object):
+    """ Returns the same text for every image and counts the OCR calls """
+
+    def __init__(self, text="Penny\nSumme 4,99\n"):
+        self.text = text
+        self.calls = 0
+
+    def image_to_string(self, img, psm=6):
+        self.calls += 1
+        return self.text
+
+
+class CachedOcrTestCase(unittest.TestCase):
+    """Tests for the OCR cache in `receipt_parser_core.enhancer`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+        config = dict(_thaw(vars(read_config(os.getcwd() + "/config.yml"))), orientation=False,
+                      ocr_cache_path=os.path.join(self.tmp_dir.name, "cache"))
+        self.config = FrozenConfig(config)
+        self.cache = OcrCache(config["ocr_cache_path"])
+
+        self.img = np.full((120, 400, 3), 245, np.uint8)
+        cv2.putText(self.img, "Summe 4,99", (20, 70), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (20, 20, 20), 2)
+
+        self.engine = CountingEngine()
+        self.version = "5.3.0"
+        self.enhance = mock.Mock(wraps=enhancer.enhance_image)
+        for name, value in [("engine_for_config", lambda config: self.engine),
+                            ("tesseract_version", lambda: self.version), ("enhance_image", self.enhance)]:
+            patcher = mock.patch.object(enhancer, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_process_image_hit(self):
+        raw, receipt = enhancer.process_image(self.config, self.img)
+        self.assertEqual((1, 1), (self.engine.calls, self.enhance.call_count))
+
+        self.assertEqual((raw, "4.99"), (enhancer.process_image(self.config, self.img)[0], receipt.sum))
+        # neither enhanced nor OCRed again
+        self.assertEqual((1, 1), (self.engine.calls, self.enhance.call_count))
+
+    def test_key_settings(self):
+        enhancer.process_image(self.config, self.img)
+
+        english = FrozenConfig(dict(_thaw(vars(self.config)), language="eng"))
+        runs = [
+            lambda: enhancer.process_image(self.config, self.img, rotate="projection"),
+            lambda: enhancer.process_image(self.config, self.img, gaussian_blur=False),
+            # the blur only works on one channel
+            lambda: enhancer.process_image(self.config, self.img, grayscale=False, gaussian_blur=False),
+            lambda: enhancer.process_image(english, self.img),
+        ]
+        for calls, run in enumerate(runs, 2):
+            run()
+            self.assertEqual(calls, self.engine.calls)
+
+        self.version = "5.4.0"
+        enhancer.process_image(self.config, self.img)
+        self.assertEqual(len(runs) + 2, self.engine.calls)
+
+        # every result is still cached under its own key
+        self.version = "5.3.0"
+        for run in runs:
+            run()
+        self.assertEqual(len(runs) + 2, self.engine.calls)
+
+    def test_ocr_images_hit(self):
+        input_folder, output_folder = (os.path.join(self.tmp_dir.name, name) for name in ("img", "txt"))
+        for name, folder in [("INPUT_FOLDER", input_folder), ("OUTPUT_FOLDER", output_folder)]:
+            os.makedirs(folder)
+            patcher = mock.patch.object(enhancer, name, folder)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        cv2.imwrite(os.path.join(input_folder, "receipt.png"), self.img)
+
+        def ocr(language="deu"):
+            results = enhancer.ocr_images(["receipt.png"], language, 1, self.engine, self.cache, rotate=False)
+            with open(results[0][1], encoding="utf-8") as text_file:
+                self.assertEqual(self.engine.text, text_file.read())
+
+        ocr()
+        ocr()
+        self.assertEqual((1, 1), (self.engine.calls, self.enhance.call_count))
+
+        ocr("eng")
+        self.assertEqual((2, 2), (self.engine.calls, self.enhance.call_count))
+
+
+if __name__ == "__main__":
+    unittest.main()
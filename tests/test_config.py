@@ -0,0 +1,99 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from receipt_parser_core.config import ConfigError, read_config, require_keys
+from receipt_parser_core.profile import get_profile
+from receipt_parser_core.receipt import Receipt
+
+
+class ConfigTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.config`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+        self.path = os.path.join(self.tmp_dir.name, "config.yml")
+        shutil.copy(os.path.join(os.getcwd(), "config.yml"), self.path)
+
+    def rewrite(self, old, new):
+        with open(self.path, encoding="utf-8") as stream:
+            text = stream.read()
+        with open(self.path, "w", encoding="utf-8") as stream:
+            stream.write(text.replace(old, new))
+
+        # make sure the change is visible even on coarse mtime clocks
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    def test_loaded_once(self):
+        config = read_config(self.path)
+
+        self.assertIs(config, read_config(self.path))
+        self.assertIs(config, read_config(os.path.relpath(self.path)))
+
+    def test_reloaded_on_change(self):
+        config = read_config(self.path)
+        self.rewrite("language: deu", "language: eng")
+
+        reloaded = read_config(self.path)
+        self.assertIsNot(config, reloaded)
+        self.assertEqual("eng", reloaded.language)
+        self.assertIsNot(get_profile(config), get_profile(reloaded))
+
+    def test_frozen(self):
+        config = read_config(self.path)
+
+        with self.assertRaises(AttributeError):
+            config.language = "eng"
+        with self.assertRaises(TypeError):
+            config.markets["Penny"] = ["penny"]
+        self.assertIsInstance(config.sum_keys, tuple)
+
+    def test_missing_key(self):
+        self.rewrite("date_format:", "date_pattern:")
+
+        with self.assertRaisesRegex(ConfigError, "date_format"):
+            read_config(self.path)
+
+    def test_parser_only_config(self):
+        # the fixture has no OCR or pipeline settings
+        config = read_config(os.path.join(os.getcwd(), "tests/data/config.yml"))
+
+        self.assertEqual("4.99", Receipt(config, ["penny\n", "summe 4,99\n"]).sum)
+        with self.assertRaisesRegex(ConfigError, "language"):
+            require_keys(config, "language")
+
+    def test_invalid_pattern(self):
+        self.rewrite("item_format_metro: '", "item_format_metro: '(")
+
+        with self.assertRaisesRegex(ConfigError, "item_format_metro"):
+            read_config(self.path)
+
+    def test_market_settings_resolved_once(self):
+        profile = get_profile(read_config(self.path))
+
+        self.assertIs(profile.market("Metro"), profile.market("Metro"))
+        self.assertIsNot(profile.market(None), profile.market("Metro"))
+        self.assertIs(profile.market(None).stop_pattern, profile.market(None).stop_pattern)
+        with self.assertRaises(AttributeError):
+            profile.market(None).item_pattern = None
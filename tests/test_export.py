@@ -0,0 +1,107 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import math
+import os
+import tempfile
+import unittest
+
+from receipt_parser_core.config import read_config
+from receipt_parser_core.export import ColumnarExport, read_table
+from receipt_parser_core.parse import export_receipts, iter_files_in_folder, iter_receipts
+
+
+class ExportTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.export`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+        self.config = read_config(os.path.join(os.getcwd(), "config.yml"))
+        self.receipt_files = sorted(iter_files_in_folder("tests/data/receipts"))
+        self.receipts = list(iter_receipts(self.config, self.receipt_files))
+
+    def export(self, export_format, chunk_size=2, append=False):
+        with ColumnarExport(self.tmp_dir.name, export_format, chunk_size, append) as export:
+            for receipt_path, receipt in self.receipts:
+                export.add(receipt_path, receipt)
+
+    def check_tables(self, export_format):
+        receipts = read_table(self.tmp_dir.name, "receipts", export_format)
+        items = read_table(self.tmp_dir.name, "items", export_format)
+
+        self.assertEqual(list(range(len(self.receipts))), receipts["id"].tolist())
+        self.assertEqual(self.receipt_files, receipts["path"].tolist())
+        for (receipt_path, receipt), total in zip(self.receipts, receipts["sum"]):
+            if receipt.sum is None:
+                self.assertTrue(math.isnan(total))
+            else:
+                self.assertAlmostEqual(float(receipt.sum), total)
+
+        expected = [
+            (receipt_id, item.article, float(item.sum))
+            for receipt_id, (_, receipt) in enumerate(self.receipts) for item in receipt.items
+        ]
+        self.assertTrue(expected)
+        self.assertEqual(expected, list(zip(items["receipt_id"].tolist(), items["article"].tolist(),
+                                            items["amount"].tolist())))
+
+    def test_npz(self):
+        self.export("npz")
+
+        self.check_tables("npz")
+        self.assertEqual(math.ceil(len(self.receipts) / 2),
+                         len([name for name in os.listdir(self.tmp_dir.name) if name.startswith("items-")]))
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+    def test_parquet(self):
+        self.export("parquet")
+
+        self.check_tables("parquet")
+
+    def test_append(self):
+        self.export("npz")
+        self.export("npz", append=True)
+
+        receipts = read_table(self.tmp_dir.name, "receipts", "npz")
+        self.assertEqual(list(range(2 * len(self.receipts))), receipts["id"].tolist())
+
+        self.export("npz")
+        self.check_tables("npz")
+
+    def test_drop(self):
+        self.export("npz")
+
+        dropped = self.receipt_files[0]
+        with ColumnarExport(self.tmp_dir.name, "npz", 2, append=True) as export:
+            export.add(*self.receipts[0])
+            self.assertEqual(1, export.drop([dropped]))
+
+        receipts = read_table(self.tmp_dir.name, "receipts", "npz")
+        items = read_table(self.tmp_dir.name, "items", "npz")
+        self.assertEqual(list(range(1, len(self.receipts) + 1)), receipts["id"].tolist())
+        self.assertEqual(self.receipt_files[1:] + [dropped], receipts["path"].tolist())
+        self.assertNotIn(0, items["receipt_id"].tolist())
+        self.assertEqual(len(self.receipts[0][1].items), items["receipt_id"].tolist().count(len(self.receipts)))
+
+    def test_export_receipts(self):
+        stats = export_receipts(self.config, self.receipt_files, self.tmp_dir.name, "npz")
+
+        self.assertEqual(len(self.receipt_files), stats["total"])
+        self.check_tables("npz")
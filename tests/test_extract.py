@@ -0,0 +1,85 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+import cv2
+import numpy as np
+
+from receipt_parser_core.config import FrozenConfig, _thaw, read_config
+from receipt_parser_core.extract import extract_fields, text_bands
+
+
+class ScriptedEngine(object):
+    """ Returns one prepared text per OCR call and remembers the image heights """
+
+    def __init__(self, *texts):
+        self.texts = list(texts)
+        self.heights = []
+
+    def image_to_string(self, img, psm=6):
+        self.heights.append(img.shape[0])
+        return self.texts.pop(0)
+
+
+class ExtractTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.extract`."""
+
+    config = FrozenConfig(dict(_thaw(vars(read_config(os.getcwd() + "/config.yml"))), orientation=False))
+
+    def setUp(self):
+        self.img = np.full((900, 400, 3), 245, np.uint8)
+        for index, y in enumerate(range(50, 870, 40)):
+            cv2.putText(self.img, "Artikel %d   1,99" % index, (20, y), cv2.FONT_HERSHEY_SIMPLEX, 0.8, (20, 20, 20), 2)
+
+    def test_text_bands(self):
+        bands = text_bands(self.img)
+
+        self.assertEqual(21, len(bands))
+        for (top, bottom), y in zip(bands, range(50, 870, 40)):
+            self.assertLess(top, y)
+            self.assertGreater(bottom, y - 10)
+        self.assertEqual([], text_bands(np.full((100, 100), 255, np.uint8)))
+
+    def test_header_and_total(self):
+        engine = ScriptedEngine("Penny Markt GmbH\n12.03.2019\n", "Summe EUR 12,50\nVielen Dank\n")
+        receipt = extract_fields(self.config, self.img, engine=engine)
+
+        self.assertEqual(("Penny", "12.03.2019", "12.50"), (receipt.market, receipt.date, receipt.sum))
+        self.assertIsNone(receipt.items)
+        # only the header and one window at the bottom are OCRed
+        self.assertEqual(2, len(engine.heights))
+        self.assertLess(sum(engine.heights), 0.8 * 1080)
+
+    def test_search_stops_early(self):
+        engine = ScriptedEngine("Vielen Dank\n", "Summe 12,50\n")
+        receipt = extract_fields(self.config, self.img, ("sum",), engine=engine, window_lines=4)
+
+        self.assertEqual("12.50", receipt.sum)
+        self.assertEqual(2, len(engine.heights))
+
+    def test_full_page_fallback(self):
+        engine = ScriptedEngine("Penny\n", "Danke\n", "Danke\n", "Penny\n17.04.2019\nSumme 3,00\n")
+        receipt = extract_fields(self.config, self.img, engine=engine, max_windows=2)
+
+        self.assertEqual(("Penny", "17.04.2019", "3.00"), (receipt.market, receipt.date, receipt.sum))
+        self.assertEqual(1080, engine.heights[-1])
+
+    def test_unknown_field(self):
+        with self.assertRaises(ValueError):
+            extract_fields(self.config, self.img, ("total",))
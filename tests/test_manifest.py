@@ -0,0 +1,99 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+from receipt_parser_core.manifest import Manifest, config_fingerprint
+from receipt_parser_core.objectview import ObjectView
+
+
+class ManifestTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.manifest`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+        self.manifest_path = os.path.join(self.tmp_dir.name, "manifest", "ocr.json")
+        self.input = self.write("receipt.jpg", b"image")
+        self.output = self.write("receipt.jpg.txt", b"summe 4,99")
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, "wb") as stream:
+            stream.write(data)
+        return path
+
+    def recorded(self, fingerprint="config"):
+        manifest = Manifest(self.manifest_path, fingerprint)
+        manifest.record("receipt.jpg", self.input, [self.output])
+        manifest.save()
+        return Manifest(self.manifest_path, fingerprint)
+
+    def test_config_fingerprint(self):
+        config = ObjectView({"language": "deu", "workers": 0})
+        other = ObjectView({"language": "deu", "workers": 4})
+
+        self.assertEqual(config_fingerprint(config, ["language"]), config_fingerprint(other, ["language"]))
+        self.assertNotEqual(config_fingerprint(config), config_fingerprint(other))
+
+    def test_unchanged_input_is_current(self):
+        manifest = self.recorded()
+
+        self.assertTrue(manifest.is_current("receipt.jpg", self.input))
+        self.assertEqual(["new.jpg"], manifest.pending(["receipt.jpg", "new.jpg"], self.tmp_dir.name))
+
+    def test_touched_input_is_current(self):
+        manifest = self.recorded()
+        os.utime(self.input, ns=(0, 0))
+
+        self.assertTrue(manifest.is_current("receipt.jpg", self.input))
+
+    def test_changed_input(self):
+        manifest = self.recorded()
+        self.write("receipt.jpg", b"other")
+
+        self.assertFalse(manifest.is_current("receipt.jpg", self.input))
+
+    def test_changed_config(self):
+        self.recorded("config")
+
+        self.assertFalse(Manifest(self.manifest_path, "other").is_current("receipt.jpg", self.input))
+
+    def test_missing_output(self):
+        manifest = self.recorded()
+        os.remove(self.output)
+
+        self.assertFalse(manifest.is_current("receipt.jpg", self.input))
+
+    def test_prune(self):
+        manifest = self.recorded()
+
+        self.assertEqual([], manifest.prune(["receipt.jpg"]))
+        self.assertEqual(["receipt.jpg"], manifest.prune([]))
+        self.assertFalse(os.path.exists(self.output))
+        self.assertNotIn("receipt.jpg", manifest)
+
+    def test_prune_missing(self):
+        manifest = self.recorded()
+
+        self.assertEqual([], manifest.prune_missing(self.tmp_dir.name))
+        os.remove(self.input)
+        self.assertEqual(["receipt.jpg"], manifest.prune_missing(self.tmp_dir.name))
+        self.assertFalse(os.path.exists(self.output))
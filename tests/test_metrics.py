@@ -0,0 +1,93 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+
+from receipt_parser_core import metrics
+from receipt_parser_core.config import read_config
+from receipt_parser_core.objectview import ObjectView
+from receipt_parser_core.receipt import Receipt
+
+
+class RecordingSink(object):
+    enabled = True
+
+    def __init__(self):
+        self.events = []
+
+    def emit(self, event):
+        self.events.append(event)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.metrics`."""
+
+    config = read_config(os.getcwd() + "/config.yml")
+
+    def tearDown(self):
+        metrics.set_sink(None)
+
+    def test_receipt_stages(self):
+        sink = RecordingSink()
+        metrics.set_sink(sink)
+
+        Receipt(self.config, ["penny\n", "summe 4,99\n"])
+
+        stages = [event.stage for event in sink.events]
+        for stage in ["parse_market", "parse_sum", "scan_lines", "parse"]:
+            self.assertIn(stage, stages)
+        for event in sink.events:
+            self.assertEqual("ok", event.outcome)
+            self.assertEqual((2,), event.shape)
+
+    def test_error_outcome(self):
+        sink = RecordingSink()
+        metrics.set_sink(sink)
+
+        @metrics.instrumented("broken")
+        def broken():
+            raise ValueError()
+
+        self.assertRaises(ValueError, broken)
+        self.assertEqual("error", sink.events[0].outcome)
+
+    def test_prometheus(self):
+        sink = metrics.PrometheusSink()
+        metrics.set_sink(sink)
+
+        metrics.emit("deskew_image", 0.02, (100, 100))
+        metrics.emit("deskew_image", 2.0, (100, 100))
+
+        text = sink.render()
+        self.assertIn('receipt_parser_stage_seconds_bucket{stage="deskew_image",outcome="ok",le="0.05"} 1', text)
+        self.assertIn('receipt_parser_stage_seconds_count{stage="deskew_image",outcome="ok"} 2', text)
+
+    def test_prometheus_served_once(self):
+        # run serves it once for the OCR and again for the parse step
+        config = ObjectView({"metrics": "prometheus", "metrics_port": 0})
+
+        sink = metrics.sink_from_config(config)
+        self.assertIs(sink, metrics.sink_from_config(config))
+
+    def test_null_sink(self):
+        self.assertIs(metrics.NULL_SINK, metrics.get_sink())
+        self.assertFalse(metrics.get_sink().enabled)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import os
+import tempfile
+import unittest
+
+from PIL import Image
+
+from receipt_parser_core.enhancer import find_images
+from receipt_parser_core.pages import document_type, iter_pages, join_pages
+
+
+class PagesTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.pages`."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def save(self, name, **kwargs):
+        # a red and a blue page
+        pages = [Image.new("RGB", (200, 100), (255, 0, 0)), Image.new("RGB", (200, 100), (0, 0, 255))]
+        path = os.path.join(self.tmp_dir.name, name)
+        pages[0].save(path, save_all=True, append_images=pages[1:], **kwargs)
+        return path
+
+    def test_tiff(self):
+        path = self.save("receipt.tif")
+
+        self.assertEqual("tiff", document_type(path))
+        pages = iter_pages(path)
+        self.assertEqual([0, 0, 255], next(pages)[50, 50].tolist())
+        self.assertEqual([255, 0, 0], next(pages)[50, 50].tolist())
+        self.assertIsNone(next(pages, None))
+
+    @unittest.skipUnless(importlib.util.find_spec("pypdfium2"), "pypdfium2 is not installed")
+    def test_pdf(self):
+        path = self.save("receipt.pdf", resolution=100)
+        with open(path, "rb") as stream:
+            data = stream.read()
+
+        self.assertEqual("pdf", document_type(data))
+        shapes = [page.shape for page in iter_pages(path, dpi=200)]
+        self.assertEqual([(200, 400, 3)] * 2, shapes)
+        self.assertEqual(shapes, [page.shape for page in iter_pages(data, dpi=200)])
+
+    def test_images(self):
+        path = os.path.join(self.tmp_dir.name, "receipt.png")
+        Image.new("RGB", (20, 10), (255, 255, 255)).save(path)
+
+        self.assertIsNone(document_type(path))
+        self.assertEqual([(10, 20, 3)], [page.shape for page in iter_pages(path)])
+        with self.assertRaises(ValueError):
+            next(iter_pages(b"no image"))
+
+    def test_find_documents(self):
+        self.save("receipt.pdf", resolution=100)
+        with open(os.path.join(self.tmp_dir.name, "notes.txt"), "w") as stream:
+            stream.write("no receipt")
+
+        self.assertEqual(["receipt.pdf"], list(find_images(self.tmp_dir.name)))
+
+    def test_join_pages(self):
+        self.assertEqual("penny\nsumme 0,99\n", join_pages(["penny", "", "summe 0,99\n"]))
@@ -15,12 +15,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import argparse
+import contextlib
+import fnmatch
+import io
+import json
 import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
-from receipt_parser_core.config import read_config
-from receipt_parser_core.enhancer import prepare_folders, process_receipt
-from receipt_parser_core.receipt import Receipt
+import cv2
+import numpy as np
+
+import receipt_parser_core
+from receipt_parser_core.config import FrozenConfig, _thaw, read_config
+from receipt_parser_core.enhancer import assess_image, crop_to_document, detect_orientation, enhance_image, \
+    estimate_skew, ocr_images, plan_enhancement, prepare_folders, process_image, process_image_bytes, process_receipt, \
+    remove_shadows, rotate_image, rotate_landscape, rotate_upright
+from receipt_parser_core.ocr import get_engine
+from receipt_parser_core.parse import iter_files_in_folder, parse_many, parse_receipts, write_json_lines
+from receipt_parser_core.profile import get_profile, keyword_pattern
+from receipt_parser_core.receipt import Receipt, ReceiptBatch
+
+
+class ScriptedEngine(object):
+    """ Returns a prepared text for every image and keeps the images """
+
+    def __init__(self, text):
+        self.text = text
+        self.images = []
+
+    def image_to_string(self, img, psm=6):
+        self.images.append(img)
+        return self.text
 
 
 class ReceiptTestCase(unittest.TestCase):
@@ -200,6 +232,195 @@ class ReceiptTestCase(unittest.TestCase):
         receipt = Receipt(self.config, ["RK Tankstellen"])
         self.assertEqual("Tanken", receipt.parse_market())
 
+    def test_market_matcher_matches_fuzzy_find(self):
+        """
+            Verifies the precompiled market matcher finds the same market
+            as searching every spelling with fuzzy_find
+        """
+
+        def fuzzy_find_market(receipt):
+            for int_accuracy in range(10, 6, -1):
+                for market, spellings in self.config.markets.items():
+                    for spelling in spellings:
+                        if receipt.fuzzy_find(spelling, int_accuracy / 10.0):
+                            return market
+
+        samples = [["penny"], ["rew"], ["REL"], ["kaser"], ["esso station"], ["lidi markt"],
+                   ["nothing to see here"], ["p e n ny"], []]
+        receipts_path = self.dir_path + "/tests/data/receipts/"
+        for file_name in sorted(os.listdir(receipts_path)):
+            with open(receipts_path + file_name) as receipt_file:
+                samples.append(receipt_file.readlines())
+
+        for lines in samples:
+            receipt = Receipt(self.config, lines)
+            self.assertEqual(fuzzy_find_market(receipt), receipt.parse_market())
+
+    def test_scan_lines(self):
+        """
+            Verifies the date is still found after the items ended
+        """
+        receipt = Receipt(self.config, ["penny\n", "milch 0,99 \n", "summe 0,99\n", "19.08.15\n"])
+
+        self.assertEqual("19.08.15", receipt.date)
+        self.assertEqual([("milch", "0.99")], [tuple(item) for item in receipt.items])
+        self.assertEqual((receipt.date, receipt.items), receipt.scan_lines())
+
+    def test_write_json_lines(self):
+        receipts_path = "tests/data/receipts"
+        receipt_files = sorted(iter_files_in_folder(receipts_path))
+
+        out = io.StringIO()
+        stats = write_json_lines(self.config, iter(receipt_files), out)
+
+        results = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(receipt_files, [result["path"] for result in results])
+        self.assertEqual(len(receipt_files), stats["total"])
+        self.assertEqual(sum(1 for result in results if result["sum"]), stats["sum"])
+
+        with open(receipt_files[0], encoding="utf8") as receipt_file:
+            expected = json.loads(Receipt(self.config, receipt_file.readlines()).to_json())
+        del results[0]["path"]
+        self.assertEqual(expected, results[0])
+
+    def test_parse_receipts_incremental(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        receipts_path = shutil.copytree("tests/data/receipts", os.path.join(tmp_dir.name, "receipts"))
+        config = FrozenConfig(dict(_thaw(vars(self.config)), receipts_path=receipts_path,
+                                   manifest_path=os.path.join(tmp_dir.name, "manifest"), workers=1))
+        jsonl = os.path.join(tmp_dir.name, "results.jsonl")
+
+        def run(**options):
+            args = argparse.Namespace(**dict(dict(jsonl=jsonl, export=None, export_format=None, workers=None,
+                                                  force=False, prune=False), **options))
+            with contextlib.redirect_stdout(io.StringIO()):
+                return parse_receipts(config, args)
+
+        def records():
+            with open(jsonl, encoding="utf-8") as stream:
+                return [json.loads(line) for line in stream]
+
+        receipt_files = sorted(iter_files_in_folder(receipts_path))
+        self.assertEqual(len(receipt_files), run()["total"])
+        self.assertEqual(0, run()["total"])
+
+        # a changed receipt replaces its record, a removed one is dropped with --prune
+        with open(receipt_files[0], "a", encoding="utf-8") as stream:
+            stream.write("Summe 99,99\n")
+        os.remove(receipt_files[1])
+        self.assertEqual(1, run(prune=True)["total"])
+
+        paths = [record["path"] for record in records()]
+        self.assertEqual(sorted(receipt_files[:1] + receipt_files[2:]), sorted(paths))
+        self.assertEqual(receipt_files[0], paths[-1])
+
+        # the table always lists every receipt
+        self.assertEqual(len(receipt_files) - 1, run(jsonl=None)["total"])
+        self.assertEqual(len(receipt_files) - 1, run(jsonl=None)["total"])
+
+    def test_receipt_batch(self):
+        """
+            Verifies a batch returns the same results as the receipts it holds
+        """
+        receipts = []
+        for receipt_path in sorted(iter_files_in_folder("tests/data/receipts")):
+            with open(receipt_path, encoding="utf8") as receipt_file:
+                receipts.append(Receipt(self.config, receipt_file.readlines()))
+
+        batch = ReceiptBatch(receipts, keep_lines=True)
+        self.assertEqual(len(receipts), len(batch))
+        self.assertEqual([receipt.to_json() for receipt in receipts],
+                         [batch.to_json(i) for i in range(len(batch))])
+
+        compact = ReceiptBatch(receipts)
+        self.assertEqual([receipt.items for receipt in receipts], [compact.items(i) for i in range(len(compact))])
+        self.assertEqual([], compact.lines(0))
+
+    def test_drop_lines(self):
+        lines = ["penny\n", "milch 0,99 \n", "summe 0,99\n", "19.08.15\n"]
+        receipt = Receipt(self.config, list(lines), keep_lines=False)
+
+        self.assertEqual((), receipt.lines)
+        self.assertEqual(Receipt(self.config, list(lines)).to_dict(), dict(receipt.to_dict(), lines=lines))
+        self.assertFalse(hasattr(receipt, "__dict__"))
+
+    def test_parse_many(self):
+        receipt_files = sorted(iter_files_in_folder("tests/data/receipts"))
+        sources = receipt_files + ["tests/data/receipts/missing.txt", ["penny\n", "summe 0,99\n"]]
+
+        expected = [Receipt(self.config, ["penny\n", "summe 0,99\n"]).to_json()]
+        for receipt_path in receipt_files:
+            with open(receipt_path, encoding="utf8") as receipt_file:
+                expected.insert(-1, Receipt(self.config, receipt_file.readlines()).to_json())
+
+        results = list(parse_many(self.config, sources, workers=2, chunksize=2))
+        self.assertEqual(list(range(len(sources))), [result.index for result in results])
+        self.assertEqual(sources, [result.source for result in results])
+        self.assertIn("FileNotFoundError", results[-2].error)
+        self.assertEqual(expected, [result.receipt.to_json() for result in results if result.error is None])
+        self.assertIs(get_profile(self.config), results[0].receipt.profile)
+
+        unordered = parse_many(self.config, sources, workers=2, chunksize=1, ordered=False)
+        self.assertEqual(list(range(len(sources))), sorted(result.index for result in unordered))
+
+        # an iterator is only read a few chunks ahead of the results
+        remaining = iter(sources * 20)
+        results = parse_many(self.config, remaining, workers=2, chunksize=2)
+        self.assertEqual(sources[0], next(results).source)
+        self.assertGreater(len(list(remaining)), len(sources) * 10)
+        results.close()
+
+    def test_pickle_receipt(self):
+        receipt = Receipt(self.config, ["penny\n", "milch 0,99 \n", "summe 0,99\n", "19.08.15\n"])
+
+        data = pickle.dumps(receipt)
+        self.assertNotIn(b"item_format", data)
+        self.assertEqual(receipt.to_json(), pickle.loads(data).to_json())
+        self.assertEqual(self.config.markets, pickle.loads(pickle.dumps(self.config)).markets)
+
+    def test_keyword_pattern(self):
+        """
+            Verifies the combined keyword pattern finds the same lines as fnmatch
+        """
+        keywords = ["mwst", "kg x", "zw-summe", "st?x", "[0-9]x"]
+        pattern = keyword_pattern(keywords)
+
+        for line in ["mwst 19%\n", "1,5 kg x 2,99\n", "zw-summe 3,00\n", "stkx\n",
+                     "2x milch\n", "milch 0,99\n", "summe 1,00\n", "\n"]:
+            expected = any(fnmatch.fnmatch(line, f"*{keyword}*") for keyword in keywords)
+            self.assertEqual(expected, bool(pattern.search(line)), line)
+
+        self.assertIsNone(keyword_pattern([]))
+
+    def test_profile_is_shared(self):
+        first = Receipt(self.config, ["penny\n"])
+        second = Receipt(self.config, ["rewe\n"])
+
+        self.assertIs(first.profile, second.profile)
+        self.assertIs(get_profile(self.config).market("Metro"), first.profile.market("Metro"))
+
+    def test_text_parsing_skips_image_stack(self):
+        script = (
+            "import sys, receipt_parser_core; receipt_parser_core.Receipt; "
+            "print(' '.join(m for m in ('cv2', 'numpy', 'PIL', 'wand', 'pytesseract', 'terminaltables') "
+            "if m in sys.modules))"
+        )
+        loaded = subprocess.run(
+            [sys.executable, "-c", script], cwd=os.getcwd(), check=True, capture_output=True, text=True
+        ).stdout.split()
+
+        self.assertEqual([], loaded)
+
+    def test_star_import(self):
+        namespace = {}
+        exec("from receipt_parser_core import *", namespace)
+
+        for name in ("Receipt", "read_config", "get_files_in_folder", "ocr_receipts", "results_to_json", "main"):
+            self.assertIn(name, namespace)
+        self.assertIn("parse_many", dir(receipt_parser_core))
+
     def test_parse_sum(self):
         """
             Verifies parse_sum
@@ -251,5 +472,172 @@ class ReceiptTestCase(unittest.TestCase):
 
         self.assertEqual("4.99", r.sum)
 
+    def test_rotate_landscape(self):
+        landscape = np.zeros((20, 30, 3), np.uint8)
+        landscape[0, 0] = 255
+
+        rotated = rotate_landscape(landscape)
+        self.assertEqual((30, 20, 3), rotated.shape)
+        # clockwise: the top left corner ends up top right
+        self.assertEqual(255, rotated[0, 19, 0])
+
+        portrait = np.zeros((30, 20), np.uint8)
+        self.assertIs(portrait, rotate_landscape(portrait))
+
+    def test_detect_orientation(self):
+        img = np.full((600, 1400, 3), 255, np.uint8)
+        for y in range(60, 560, 45):
+            cv2.putText(img, "SUMME 12,99 EUR 0123 ABC", (40, y), cv2.FONT_HERSHEY_SIMPLEX, 1.1, (0, 0, 0), 2)
+
+        # wide, but the text is upright already
+        self.assertEqual(0, detect_orientation(img))
+        self.assertEqual(90, detect_orientation(img, "landscape"))
+        for angle in (90, 180, 270):
+            self.assertEqual(angle, detect_orientation(rotate_upright(img, -angle)))
+
+        # a narrow receipt in mixed case, with its text in columns
+        receipt = np.full((900, 420, 3), 255, np.uint8)
+        for y in range(40, 880, 40):
+            cv2.putText(receipt, "Milch    1,19 B", (20, y), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 0), 2)
+        for angle in (0, 90, 180, 270):
+            self.assertEqual(angle, detect_orientation(rotate_upright(receipt, -angle)))
+
+        # tesseract agrees, or the projection profiles decide if it is unavailable
+        self.assertEqual(0, detect_orientation(img, "osd"))
+
+    def test_rotate_upright(self):
+        img = np.arange(24, dtype=np.uint8).reshape(4, 6)
+
+        self.assertIs(img, rotate_upright(img, 0))
+        self.assertTrue(np.array_equal(np.rot90(img, -1), rotate_upright(img, 90)))
+        self.assertTrue(np.array_equal(img, rotate_upright(rotate_upright(img, 90), 270)))
+        self.assertTrue(np.array_equal(np.rot90(img, 2), rotate_upright(img, -180)))
+
+    def test_rotate_image(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_file = os.path.join(tmp_dir, "landscape.png")
+            output_file = os.path.join(tmp_dir, "rotated.png")
+            img = np.zeros((20, 30, 3), np.uint8)
+            img[0, 0] = 255
+            cv2.imwrite(input_file, img)
+
+            rotate_image(input_file, output_file)
+            self.assertTrue(np.array_equal(rotate_landscape(img), cv2.imread(output_file)))
+
+    def test_estimate_skew(self):
+        img = np.full((800, 600, 3), 255, np.uint8)
+        for y in range(60, 760, 40):
+            cv2.putText(img, "SUMME 12,99 EUR 0123", (40, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+
+        for angle in (-3.4, 0, 2.2):
+            M = cv2.getRotationMatrix2D((300, 400), angle, 1.0)
+            skewed = cv2.warpAffine(img, M, (600, 800), borderValue=(255, 255, 255))
+            self.assertAlmostEqual(-angle, estimate_skew(skewed), delta=0.2)
+
+    def test_plan_enhancement(self):
+        img = np.full((1600, 1200, 3), 255, np.uint8)
+        for y in range(100, 1500, 60):
+            cv2.putText(img, "SUMME 12,99 EUR 0123", (60, y), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+
+        plan = plan_enhancement(assess_image(img))
+        self.assertEqual("clean", str(plan))
+
+        M = cv2.getRotationMatrix2D((600, 800), 3, 1.0)
+        skewed = cv2.warpAffine(img, M, (1200, 1600), borderValue=(255, 255, 255))
+        self.assertAlmostEqual(-3, plan_enhancement(assess_image(skewed)).skew, delta=0.2)
+
+        # brightness falling off towards the bottom, as in a shadow
+        shadow = np.linspace(1.0, 0.4, 1600)[:, None, None]
+        plan = plan_enhancement(assess_image((img * shadow).astype(np.uint8)))
+        self.assertTrue(plan.remove_shadows)
+        self.assertTrue(plan.remove_noise)
+
+        small = cv2.resize(img, (600, 800))
+        self.assertAlmostEqual(1.58, plan_enhancement(assess_image(small)).scale, places=2)
+
+    def test_grayscale_first(self):
+        img = np.full((800, 600, 3), 255, np.uint8)
+        for y in range(60, 760, 40):
+            cv2.putText(img, "SUMME 12,99 EUR 0123", (40, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+        shadow = np.linspace(1.0, 0.5, 800)[:, None, None] * np.array([0.9, 1.0, 1.1])
+        img = np.clip(img * shadow, 0, 255).astype(np.uint8)
+
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # one channel gets exactly what every channel of a color image gets
+        self.assertTrue(np.array_equal(remove_shadows(cv2.merge([gray] * 3))[:, :, 1], remove_shadows(gray)))
+
+        enhanced = enhance_image(img, grayscale_first=True)
+        self.assertEqual(2, enhanced.ndim)
+        self.assertGreater((enhanced == enhance_image(img)).mean(), 0.99)
+
+    def test_crop_to_document(self):
+        receipt = np.full((900, 350, 3), 245, np.uint8)
+        for y in range(50, 870, 40):
+            cv2.putText(receipt, "SUMME 12,99", (20, y), cv2.FONT_HERSHEY_SIMPLEX, 1, (20, 20, 20), 2)
+
+        # photographed at an angle on a dark table
+        img = np.full((1200, 1600, 3), 70, np.uint8)
+        corners = np.float32([[0, 0], [350, 0], [350, 900], [0, 900]])
+        target = np.float32([[610, 130], [960, 150], [990, 1080], [580, 1060]])
+        transform = cv2.getPerspectiveTransform(corners, target)
+        paper = cv2.warpPerspective(np.full((900, 350), 255, np.uint8), transform, (1600, 1200)) > 0
+        img[paper] = cv2.warpPerspective(receipt, transform, (1600, 1200))[paper]
+
+        cropped = crop_to_document(img)
+        self.assertLess(cropped.shape[0] * cropped.shape[1], 0.3 * 1200 * 1600)
+        # the whole receipt is kept
+        self.assertEqual(paper.sum(), (crop_to_document(paper.astype(np.uint8) * 255) > 0).sum())
+
+        warped = crop_to_document(img, perspective=True)
+        # as high and wide as the longest sides of the photographed receipt
+        self.assertAlmostEqual(930, warped.shape[0], delta=40)
+        self.assertAlmostEqual(410, warped.shape[1], delta=40)
+        self.assertGreater(np.median(warped), 200)
+
+        # nothing to crop from a scan
+        self.assertIs(receipt, crop_to_document(receipt))
+
+    def test_get_engine_is_shared(self):
+        self.assertIs(get_engine("deu", 2), get_engine("deu", 2))
+        self.assertIsNot(get_engine("deu", 2), get_engine("deu", 0))
+
+    def test_engine_pickles_to_shared_engine(self):
+        engine = get_engine("deu", 2, 512, 30)
+        self.assertIs(engine, pickle.loads(pickle.dumps(engine)))
+        self.assertEqual(30, pickle.loads(pickle.dumps(engine)).timeout)
+        self.assertIsNot(engine, get_engine("deu", 2, 512))
+
+    def test_process_image_in_memory(self):
+        config = FrozenConfig(dict(_thaw(vars(self.config)), orientation=False, ocr_cache_path=None))
+        text = "Penny Markt GmbH\n12.03.2019\nMilch 1,19 B\nSumme 1,19\n"
+        engine = ScriptedEngine(text)
+
+        img = np.full((300, 400, 3), 245, np.uint8)
+        cv2.putText(img, "Summe 1,19", (20, 150), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (20, 20, 20), 2)
+
+        with mock.patch("receipt_parser_core.enhancer.engine_for_config", lambda config: engine):
+            raw, receipt = process_image(config, img)
+            from_bytes = process_image_bytes(config, cv2.imencode(".png", img)[1].tobytes())
+
+        self.assertEqual(text, raw)
+        self.assertEqual(("Penny", "12.03.2019", "1.19"), (receipt.market, receipt.date, receipt.sum))
+        self.assertEqual([("milch", "1.19")], [tuple(item) for item in receipt.items])
+        self.assertEqual(receipt.to_json(), from_bytes.to_json())
+
+        # tesseract gets the enhanced image, upscaled and on one channel
+        self.assertEqual(2, len(engine.images))
+        self.assertEqual((360, 480), engine.images[0].shape)
+
+    def test_ocr_images_isolates_failures(self):
+        prepare_folders()
+
+        images = ["does_not_exist_1.jpg", "does_not_exist_2.jpg"]
+        results = ocr_images(images, workers=2)
+
+        self.assertEqual(images, [image for image, _, _ in results])
+        for _, out_path, error in results:
+            self.assertIsNone(out_path)
+            self.assertIn("Could not read image", error)
+
 if __name__ == "__main__":
     unittest.main()
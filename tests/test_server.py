@@ -0,0 +1,114 @@
+# !/usr/bin/python3
+# coding: utf-8
+
+# Copyright 2015-2018
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import cv2
+import numpy as np
+
+from receipt_parser_core.config import read_config
+from receipt_parser_core.receipt import Receipt
+from receipt_parser_core.server import QueueFull, ReceiptServer
+
+
+class ServerTestCase(unittest.TestCase):
+    """Tests for `receipt_parser_core.server`."""
+
+    config = read_config(os.getcwd() + "/config.yml")
+
+    def setUp(self):
+        self.server = ReceiptServer(("127.0.0.1", 0), self.config, max_concurrency=1, queue_size=0)
+        self.server.warm_up(images=False)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def request(self, path, data=None):
+        try:
+            with urllib.request.urlopen(self.url + path, data, timeout=10) as response:
+                return response.status, response.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode("utf-8")
+
+    def test_text(self):
+        path = os.path.join(os.getcwd(), "tests/data/receipts/sample_text_receipt.txt")
+        with open(path, "rb") as receipt_file:
+            data = receipt_file.read()
+
+        status, body = self.request("/text", data)
+        self.assertEqual(200, status)
+
+        lines = data.decode("utf-8", errors="ignore").splitlines(keepends=True)
+        self.assertEqual(json.loads(Receipt(self.config, lines).to_json()), json.loads(body))
+
+    def test_invalid_image(self):
+        status, body = self.request("/image", b"not an image")
+        self.assertEqual(400, status)
+        self.assertIn("error", json.loads(body))
+
+    def test_unknown_field(self):
+        data = cv2.imencode(".png", np.full((100, 100), 255, np.uint8))[1].tobytes()
+        status, body = self.request("/image?fields=market,total", data)
+        self.assertEqual(400, status)
+        self.assertIn("total", json.loads(body)["error"])
+
+    def test_unknown_endpoint(self):
+        self.assertEqual(404, self.request("/nothing", b"")[0])
+
+    def test_metrics(self):
+        self.request("/text", b"Penny\n")
+        status, body = self.request("/metrics")
+
+        self.assertEqual(200, status)
+        self.assertIn('receipt_parser_request_seconds_count{endpoint="/text",outcome="ok"} 1', body)
+        self.assertIn("receipt_parser_queue_depth 0", body)
+
+    def test_warm_workers(self):
+        from receipt_parser_core.ocr import engine_for_config
+
+        self.server.warm_up()
+        engine = engine_for_config(self.config)
+
+        # the tesseract instance started by warm_up serves every request
+        tesseract = self.server.process(lambda: engine._local.tesseract)
+        self.assertIs(tesseract, self.server.process(lambda: engine._local.tesseract))
+
+    def test_queue_full(self):
+        started, release = threading.Event(), threading.Event()
+
+        def wait():
+            started.set()
+            release.wait(10)
+
+        worker = threading.Thread(target=self.server.process, args=(wait,))
+        worker.start()
+        started.wait(10)
+        try:
+            with self.assertRaises(QueueFull):
+                self.server.process(lambda: None)
+        finally:
+            release.set()
+            worker.join()